@@ -0,0 +1,13 @@
+"""Benchmarks for the read extraction and result parsing stages, run on seeded synthetic data.
+
+Usage:
+    python -m benchmarks run --scale 10k 100k
+    python -m benchmarks startup
+    python -m benchmarks compare
+"""
+import os
+import sys
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
@@ -0,0 +1,219 @@
+import os
+import random
+
+RANKS = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+GENERA = ['Escherichia', 'Bacillus', 'Staphylococcus', 'Streptococcus', 'Pseudomonas', 'Klebsiella', 'Enterococcus',
+          'Clostridium', 'Lactobacillus', 'Corynebacterium', 'Neisseria', 'Haemophilus', 'Acinetobacter', 'Listeria']
+EPITHETS = ['coli', 'aureus', 'subtilis', 'pneumoniae', 'aeruginosa', 'faecalis', 'difficile', 'acidophilus',
+            'striatum', 'meningitidis', 'influenzae', 'baumannii', 'monocytogenes', 'epidermidis', 'cereus']
+SUMMARY_HEADER = ['filename', 'read_id', 'run_id', 'channel', 'start_time', 'duration', 'num_events',
+                  'passes_filtering', 'sequence_length_template', 'mean_qscore_template']
+READS_PER_FASTQ = 4000
+RUN_HOURS = 48
+COMPLETE_MARKER = '.complete'
+
+
+def parse_scale(scale):
+    """Returns a read count from e.g. '10k', '2.5M' or '50000'."""
+    scale = str(scale).strip().lower()
+    multiplier = {'k': 10 ** 3, 'm': 10 ** 6}.get(scale[-1:], 1)
+    if multiplier > 1:
+        scale = scale[:-1]
+    return int(float(scale) * multiplier)
+
+
+class SequencePool(object):
+    """Pre-generated random bases and quality characters that reads are sliced from, so generating millions of reads
+    does not mean drawing every base individually.
+
+    Args:
+        rng (random.Random): seeded random number generator
+        size (int): length of the base and quality pools
+
+    """
+
+    def __init__(self, rng, size=1 << 20):
+        self.rng = rng
+        self.size = size
+        self.bases = ''.join(rng.choice('ACGT') for _ in range(size))
+        self.quals = ''.join(chr(33 + int(rng.triangular(2, 30, 14))) for _ in range(size))
+
+    def read(self, length):
+        start = self.rng.randrange(0, self.size - length)
+        return self.bases[start:start + length], self.quals[start:start + length]
+
+
+def write_taxonomy(prefix, rng, n_genera=400, species_per_genus=6):
+    """Writes NCBI-style .tree and .names files with a full rank hierarchy.
+
+    Returns:
+        taxids (dict): rank to list of taxonomy ids at that rank
+    """
+    tree = [(1, 1, 'no rank')]
+    names = {1: 'root'}
+    taxids = {rank: [] for rank in RANKS}
+    next_id = [2]
+
+    def add(parent, rank, name):
+        taxid = next_id[0]
+        next_id[0] += 1
+        tree.append((taxid, parent, rank))
+        names[taxid] = name
+        taxids[rank].append(taxid)
+        return taxid
+
+    bacteria = add(1, 'superkingdom', 'Bacteria')
+    parents = {'phylum': [bacteria]}
+    counts = {'phylum': 8, 'class': 20, 'order': 50, 'family': 150}
+    for rank in ['phylum', 'class', 'order', 'family']:
+        below = RANKS[RANKS.index(rank) + 1]
+        parents[below] = [add(rng.choice(parents[rank]), rank, '%s_%d' % (rank.capitalize(), i))
+                          for i in range(counts[rank])]
+    for i in range(n_genera):
+        genus_name = '%s%s' % (rng.choice(GENERA), '' if i < len(GENERA) else i)
+        genus = add(rng.choice(parents['genus']), 'genus', genus_name)
+        for epithet in rng.sample(EPITHETS, species_per_genus):
+            add(genus, 'species', '%s %s' % (genus_name, epithet))
+
+    with open(prefix + '.tree', 'w') as outfile:
+        for taxid, parent, rank in tree:
+            outfile.write('%s\t|\t%s\t|\t%s\t|\n' % (taxid, parent, rank))
+    with open(prefix + '.names', 'w') as outfile:
+        for taxid, name in names.items():
+            outfile.write('%s\t|\t%s\t|\tscientific name\t|\n' % (taxid, name))
+    return taxids
+
+
+def write_refseq_fasta(filepath, rng, pool, n_refs=5000):
+    """Writes a RefSeq 16S style fasta, returning the reference ids."""
+    ref_ids = []
+    with open(filepath, 'w') as outfile:
+        for i in range(n_refs):
+            ref_id = 'NR_%06d.1' % (100000 + i)
+            ref_ids.append(ref_id)
+            species = '%s %s' % (rng.choice(GENERA), rng.choice(EPITHETS))
+            outfile.write('>%s %s strain %s 16S ribosomal RNA, partial sequence\n' % (ref_id, species, i))
+            seq = pool.read(rng.randint(1300, 1550))[0]
+            for start in range(0, len(seq), 80):
+                outfile.write(seq[start:start + 80] + '\n')
+    return ref_ids
+
+
+def write_run(directory, rng, pool, n_reads, mean_length=1450):
+    """Writes a sequencing_summary.txt and fastq_pass/*.fastq for a run of n_reads reads over RUN_HOURS hours.
+
+    About 85% of reads pass filtering, as on a typical flow cell; only passed reads are written to FASTQ.
+    """
+    fastq_dir = os.path.join(directory, 'fastq_pass')
+    if not os.path.exists(fastq_dir):
+        os.makedirs(fastq_dir)
+    run_seconds = RUN_HOURS * 3600
+    fastq = None
+    fastq_count = 0
+    with open(os.path.join(directory, 'sequencing_summary.txt'), 'w') as summary:
+        summary.write('\t'.join(SUMMARY_HEADER) + '\n')
+        for i in range(n_reads):
+            read_id = '%08x-%04x-%04x-%04x-%012x' % (rng.getrandbits(32), rng.getrandbits(16), rng.getrandbits(16),
+                                                      rng.getrandbits(16), rng.getrandbits(48))
+            start_time = run_seconds * (float(i) + rng.random()) / n_reads
+            length = max(200, min(int(rng.gauss(mean_length, 120)), pool.size - 1))
+            passed = rng.random() < 0.85
+            qscore = rng.gauss(11.5, 1.5) if passed else rng.gauss(5.5, 1.0)
+            fastq_name = 'FAK00000_pass_%s.fastq' % (fastq_count // READS_PER_FASTQ)
+            summary.write('%s\t%s\trun0\t%s\t%.5f\t%.5f\t%s\t%s\t%s\t%.6f\n' % (
+                fastq_name if passed else 'fail.fastq', read_id, rng.randint(1, 512), start_time, length / 400.0,
+                length * 2, 'TRUE' if passed else 'FALSE', length, qscore))
+            if passed:
+                if fastq_count % READS_PER_FASTQ == 0:
+                    if fastq:
+                        fastq.close()
+                    fastq = open(os.path.join(fastq_dir, fastq_name), 'w')
+                seq, qual = pool.read(length)
+                fastq.write('@%s runid=run0 read=%s ch=1 start_time=%.0f\n%s\n+\n%s\n' % (
+                    read_id, i, start_time, seq, qual))
+                fastq_count += 1
+    if fastq:
+        fastq.close()
+
+
+def write_centrifuge_result(filepath, rng, taxids, n_reads):
+    """Writes a Centrifuge classification file: mostly species hits, some at genus or above, some below threshold
+    and some unclassified, with all hits for a read on consecutive lines."""
+    species = taxids['species']
+    genera = taxids['genus']
+    with open(filepath, 'w') as outfile:
+        outfile.write('readID\tseqID\ttaxID\tscore\t2ndBestScore\thitLength\tqueryLength\tnumMatches\n')
+        for i in range(n_reads):
+            read_id = 'read%s' % i
+            if rng.random() < 0.05:
+                outfile.write('%s\tunclassified\t0\t0\t0\t0\t1450\t1\n' % read_id)
+                continue
+            roll = rng.random()
+            if roll < 0.6:
+                hits = [rng.choice(species)]
+            elif roll < 0.9:
+                first = rng.randrange(len(species))
+                hits = species[first:first + rng.randint(2, 5)]
+            else:
+                hits = [rng.choice(genera)] + [rng.choice(species) for _ in range(rng.randint(1, 3))]
+            for taxid in hits:
+                score = rng.randint(200, 4000)
+                outfile.write('%s\tNR_%06d.1\t%s\t%s\t%s\t%s\t1450\t%s\n' % (
+                    read_id, rng.randint(100000, 104999), taxid, score, score // 2, rng.randint(300, 1450),
+                    len(hits)))
+
+
+def write_seqmatch_result(filepath, rng, ref_ids, n_reads):
+    """Writes a merged SeqMatch result with one match per read."""
+    with open(filepath, 'w') as outfile:
+        outfile.write('query name\tmatch seq\torientation\tS_ab score\tunique oligos\tmatch seq description\n')
+        for i in range(n_reads):
+            # skew towards a few abundant references, as in a real sample
+            ref_id = ref_ids[min(int(rng.expovariate(1.0 / 200)), len(ref_ids) - 1)]
+            outfile.write('read%s\t%s\t%s\t%.3f\t%s\t16S ribosomal RNA\n' % (
+                i, ref_id, rng.choice('+-'), rng.uniform(0.5, 1.0), rng.randint(200, 1400)))
+
+
+def dataset_paths(directory):
+    return {
+        'directory': directory,
+        'summary': os.path.join(directory, 'sequencing_summary.txt'),
+        'fastq_dir': os.path.join(directory, 'fastq_pass'),
+        'tree': os.path.join(directory, 'reference.tree'),
+        'names': os.path.join(directory, 'reference.names'),
+        'fasta': os.path.join(directory, 'reference.fasta'),
+        'centrifuge': os.path.join(directory, 'sample.cfg-output.tsv'),
+        'seqmatch': os.path.join(directory, 'sample.merged-sqm-results.tsv'),
+    }
+
+
+def generate_dataset(data_dir, n_reads, seed=0):
+    """Generates (or reuses) the synthetic dataset for a scale and seed.
+
+    The same scale and seed always produce the same files. A dataset is only reused if generation finished, which is
+    recorded by a marker file written last.
+
+    Args:
+        data_dir (str): directory holding all datasets
+        n_reads (int): number of reads in the run
+        seed (int): random seed
+
+    Returns:
+        paths (dict): paths to each file in the dataset, see dataset_paths
+    """
+    directory = os.path.join(data_dir, '%s_reads_seed%s' % (n_reads, seed))
+    paths = dataset_paths(directory)
+    if os.path.exists(os.path.join(directory, COMPLETE_MARKER)):
+        return paths
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    rng = random.Random(seed)
+    pool = SequencePool(rng)
+    taxids = write_taxonomy(os.path.join(directory, 'reference'), rng)
+    ref_ids = write_refseq_fasta(paths['fasta'], rng, pool)
+    write_run(directory, rng, pool, n_reads)
+    write_centrifuge_result(paths['centrifuge'], rng, taxids, n_reads)
+    write_seqmatch_result(paths['seqmatch'], rng, ref_ids, n_reads)
+    open(os.path.join(directory, COMPLETE_MARKER), 'w').close()
+    return paths
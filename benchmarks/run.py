@@ -0,0 +1,233 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from benchmarks.generators import generate_dataset, parse_scale
+from benchmarks.stages import STAGES
+from benchmarks.startup import ENTRY_POINTS, run_startup
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_HISTORY = os.path.join(BENCHMARK_DIR, 'history.json')
+DEFAULT_DATA_DIR = os.path.join(BENCHMARK_DIR, 'data')
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Runs and compares benchmarks of the pipeline stages.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run = subparsers.add_parser('run')
+    run.add_argument('--scale', action='store', nargs='+', default=['10k'])  # reads per dataset e.g. 10k 1M 10M
+    run.add_argument('--stages', action='store', nargs='+', choices=sorted(STAGES), default=sorted(STAGES))
+    run.add_argument('--repeat', action='store', type=int, default=3)  # timed runs per stage
+    run.add_argument('--seed', action='store', type=int, default=0)
+    run.add_argument('--data_dir', action='store', default=DEFAULT_DATA_DIR)  # where generated datasets are kept
+    run.add_argument('--history', action='store', default=DEFAULT_HISTORY)
+    run.add_argument('--no_save', action='store_true')  # print results without adding them to the history
+
+    startup = subparsers.add_parser('startup')
+    startup.add_argument('--modules', action='store', nargs='+', choices=ENTRY_POINTS, default=ENTRY_POINTS)
+    startup.add_argument('--repeat', action='store', type=int, default=5)  # interpreter starts per module
+    startup.add_argument('--top', action='store', type=int, default=10)  # slowest imports to list per module
+    startup.add_argument('--max_seconds', action='store', type=float, default=1.0)  # allowed start-up plus tick time
+    startup.add_argument('--history', action='store', default=DEFAULT_HISTORY)
+    startup.add_argument('--no_save', action='store_true')  # print results without adding them to the history
+
+    compare = subparsers.add_parser('compare')
+    compare.add_argument('--base', action='store')  # commit to compare against, defaults to the previous one
+    compare.add_argument('--head', action='store')  # commit to check, defaults to the latest
+    compare.add_argument('--time_threshold', action='store', type=float, default=0.10)  # allowed fractional slowdown
+    compare.add_argument('--memory_threshold', action='store', type=float, default=0.20)  # allowed memory growth
+    compare.add_argument('--history', action='store', default=DEFAULT_HISTORY)
+    return parser
+
+
+def git_commit():
+    """Returns (short commit hash, whether the working tree has uncommitted changes), or ('unknown', False)."""
+    repo = os.path.dirname(BENCHMARK_DIR)
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo).decode().strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+    return commit, bool(status.strip())
+
+
+def _measure_stage(stage, paths, repeat, queue):
+    """Runs in a child process so that peak RSS and tracemalloc figures belong to a single stage."""
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        bench = STAGES[stage](paths, work_dir)
+        bench()  # warm up: page cache and compiled reference caches
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            bench()
+            times.append(time.perf_counter() - start)
+        # traced separately, as tracemalloc slows allocation-heavy code
+        tracemalloc.start()
+        bench()
+        peak_traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put({'times': times, 'peak_traced_kb': peak_traced // 1024, 'max_rss_kb': max_rss})
+    except Exception as e:
+        queue.put({'error': '%s: %s' % (type(e).__name__, e)})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def measure_stage(stage, paths, repeat):
+    """Times a stage and records its memory use.
+
+    Returns:
+        result (dict): {'times': seconds per run, 'best', 'median', 'peak_traced_kb': peak Python allocations,
+                        'max_rss_kb': peak resident set size of the process, including stage setup}
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure_stage, args=(stage, paths, repeat, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if 'error' in result:
+        raise RuntimeError('Benchmark %s failed: %s' % (stage, result['error']))
+    times = sorted(result['times'])
+    result['best'] = times[0]
+    result['median'] = times[len(times) // 2]
+    return result
+
+
+def new_record():
+    commit, dirty = git_commit()
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'host': platform.node(),
+        'results': [],
+    }
+
+
+def run_benchmarks(scales, stages, repeat=3, seed=0, data_dir=DEFAULT_DATA_DIR):
+    """Runs each stage at each scale and returns a history record."""
+    record = new_record()
+    for scale in scales:
+        n_reads = parse_scale(scale)
+        sys.stderr.write('Generating dataset with %s reads\n' % n_reads)
+        paths = generate_dataset(data_dir, n_reads, seed)
+        for stage in stages:
+            result = measure_stage(stage, paths, repeat)
+            result.update({'stage': stage, 'reads': n_reads, 'seed': seed})
+            record['results'].append(result)
+            print('{stage}\t{reads}\t{best:.3f}s\t{median:.3f}s\t{traced}KB\t{rss}KB'.format(
+                stage=stage, reads=n_reads, best=result['best'], median=result['median'],
+                traced=result['peak_traced_kb'], rss=result['max_rss_kb']))
+            sys.stdout.flush()
+    return record
+
+
+def load_history(history_file):
+    if not os.path.exists(history_file):
+        return []
+    with open(history_file) as infile:
+        return json.load(infile)
+
+
+def save_history(history_file, history):
+    tmp_file = history_file + '.tmp'
+    with open(tmp_file, 'w') as outfile:
+        json.dump(history, outfile, indent=1)
+    os.replace(tmp_file, history_file)
+
+
+def latest_results(history, commit):
+    """Returns {(stage, reads): result} from the most recent record(s) for a commit, newest results first."""
+    results = dict()
+    for record in reversed(history):
+        if record['commit'] == commit:
+            for result in record['results']:
+                results.setdefault((result['stage'], result['reads']), result)
+    return results
+
+
+def compare_commits(history, base=None, head=None, time_threshold=0.10, memory_threshold=0.20, outfile=None):
+    """Compares the latest results of two commits and reports stages that got slower or used more memory.
+
+    Args:
+        history (list): history records, oldest first
+        base (str): commit to compare against, defaults to the most recent commit before head in the history
+        head (str): commit to check, defaults to the most recent commit in the history
+        time_threshold (float): fractional increase in best time counted as a regression
+        memory_threshold (float): fractional increase in peak RSS or traced memory counted as a regression
+
+    Returns:
+        regressions (list): (stage, reads, metric, base value, head value) for each regression
+    """
+    commits = []
+    for record in history:
+        if record['commit'] in commits:
+            commits.remove(record['commit'])
+        commits.append(record['commit'])
+    if head is None:
+        head = commits[-1] if commits else None
+    if base is None:
+        earlier = [c for c in commits if c != head]
+        base = earlier[-1] if earlier else None
+    if base is None or head is None:
+        raise ValueError('Need results for two commits to compare.')
+
+    base_results = latest_results(history, base)
+    head_results = latest_results(history, head)
+    regressions = []
+    print('Comparing %s (base) with %s (head)' % (base, head), file=outfile)
+    print('stage\treads\tbase s\thead s\ttime\ttraced\trss', file=outfile)
+    for key in sorted(set(base_results) & set(head_results)):
+        old, new = base_results[key], head_results[key]
+        changes = []
+        for metric, threshold in [('best', time_threshold), ('peak_traced_kb', memory_threshold),
+                                  ('max_rss_kb', memory_threshold)]:
+            ratio = float(new[metric]) / old[metric] if old[metric] else 1.0
+            flag = '!' if ratio > 1 + threshold else ''
+            if flag:
+                regressions.append((key[0], key[1], metric, old[metric], new[metric]))
+            changes.append('%+.1f%%%s' % ((ratio - 1) * 100, flag))
+        print('%s\t%s\t%.3f\t%.3f\t%s' % (key[0], key[1], old['best'], new['best'], '\t'.join(changes)),
+              file=outfile)
+    return regressions
+
+
+def main():
+    args = argument_parser().parse_args()
+    if args.command == 'run':
+        record = run_benchmarks(args.scale, args.stages, repeat=args.repeat, seed=args.seed, data_dir=args.data_dir)
+        if not args.no_save:
+            history = load_history(args.history)
+            history.append(record)
+            save_history(args.history, history)
+    elif args.command == 'startup':
+        record = new_record()
+        record['results'], failures = run_startup(args.modules, repeat=args.repeat, top=args.top,
+                                                  max_seconds=args.max_seconds)
+        if not args.no_save:
+            history = load_history(args.history)
+            history.append(record)
+            save_history(args.history, history)
+        for failure in failures:
+            sys.stderr.write('Start-up check failed: %s\n' % failure)
+        sys.exit(1 if failures else 0)
+    else:
+        regressions = compare_commits(load_history(args.history), base=args.base, head=args.head,
+                                      time_threshold=args.time_threshold, memory_threshold=args.memory_threshold)
+        for stage, reads, metric, old, new in regressions:
+            sys.stderr.write('Regression: %s at %s reads, %s %s -> %s\n' % (stage, reads, metric, old, new))
+        sys.exit(1 if regressions else 0)
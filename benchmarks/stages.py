@@ -0,0 +1,61 @@
+import glob
+import os
+from fastq_extraction import extract_fastq_records
+from parse_centrifuge import CentrifugeParser
+from parse_seqmatch import SeqmatchParser
+from process_sequencing_run import find_reads, find_reads_at_times, hour_to_seconds
+from transfer import LocalBackend, send_files
+
+
+def fastq_files(paths):
+    return sorted(glob.glob(os.path.join(paths['fastq_dir'], '*.fastq')))
+
+
+def bench_find_reads(paths, work_dir):
+    return lambda: find_reads(paths['summary'], hour_to_seconds(24))
+
+
+def bench_find_reads_at_times(paths, work_dir):
+    cutoffs = [hour_to_seconds(h) for h in (2, 24, 48)]
+    return lambda: find_reads_at_times(paths['summary'], cutoffs)
+
+
+def bench_extract_fastq(paths, work_dir):
+    read_ids = find_reads(paths['summary'], hour_to_seconds(24))['reads']
+    fastq_list = fastq_files(paths)
+    output_file = os.path.join(work_dir, 'extracted.fastq')
+
+    def extract():
+        with open(output_file, 'wb') as output:
+            return extract_fastq_records(fastq_list, read_ids, output)
+    return extract
+
+
+def bench_collate_cfg(paths, work_dir):
+    return lambda: CentrifugeParser().collate_cfg_results(paths['centrifuge'], paths['tree'], paths['names'])
+
+
+def bench_collate_sqm(paths, work_dir):
+    def collate():
+        sqm_parser = SeqmatchParser(paths['seqmatch'], paths['fasta'])
+        sqm_parser.collate_seqmatch_results()
+        return sqm_parser.reads_per_species
+    return collate
+
+
+def bench_transfer_local(paths, work_dir):
+    destination = os.path.join(work_dir, 'transferred')
+    os.mkdir(destination)
+    fastq_list = fastq_files(paths)
+    return lambda: send_files(LocalBackend(), fastq_list, destination, journal_directory=work_dir)
+
+
+# stage name: function taking (dataset paths, scratch directory) and returning the callable to time
+STAGES = {
+    'find_reads': bench_find_reads,
+    'find_reads_at_times': bench_find_reads_at_times,
+    'extract_fastq': bench_extract_fastq,
+    'collate_cfg': bench_collate_cfg,
+    'collate_sqm': bench_collate_sqm,
+    'transfer_local': bench_transfer_local,
+}
@@ -0,0 +1,122 @@
+"""Start-up benchmark for the automation entry points.
+
+Each entry point is imported in a fresh interpreter, optionally followed by one tick with nothing to do, so the figures
+are what cron or the daemon pays on every pass when no work is due.
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks import SCRIPTS_DIR
+
+# dependencies that should only be imported once there is work which needs them
+HEAVY_MODULES = ['reportlab', 'ete3', 'PyQt5', 'Bio', 'pyexcel', 'pyexcel_ods3', 'h5py', 'numpy']
+
+# code run after the import for one pass with nothing to do, with the config pointed at an empty directory
+NOOP_TICKS = {
+    'pipeline_automation': '''
+config.Workstation.pipeline_input = {work_dir!r}
+module.process_waiting_jobs(dict())
+''',
+    'sequencing_automation': '''
+config.Gridion.log_files = config.Gridion.sequencing_output = {work_dir!r}
+config.Gridion.processed_files = os.path.join({work_dir!r}, 'processed')
+config.Gridion.read_indexes = os.path.join({work_dir!r}, 'indexes')
+config.Gridion.run_state = os.path.join({work_dir!r}, 'run_state.sqlite')
+module.process_due_runs()
+''',
+}
+ENTRY_POINTS = ['pipeline_automation', 'sequencing_automation', 'pipeline_wrapper', 'process_sequencing_run']
+
+CHILD_SCRIPT = '''
+import importlib, json, os, resource, sys, time
+start = time.perf_counter()
+module = importlib.import_module({module!r})
+imported = time.perf_counter()
+import config
+{tick}
+ticked = time.perf_counter()
+print(json.dumps({{'import': imported - start, 'tick': ticked - imported, 'modules': sorted(sys.modules),
+                  'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}}))
+'''
+
+IMPORTTIME_REGEX = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def parse_importtime(stderr):
+    """Returns [(cumulative us, self us, depth, module)] from the output of python -X importtime."""
+    imports = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_REGEX.match(line)
+        if match:
+            imports.append((int(match.group(2)), int(match.group(1)), len(match.group(3)) // 2, match.group(4)))
+    return imports
+
+
+def measure_startup(module, tick=True):
+    """Starts an interpreter that imports module, and runs a no-op tick if one is defined, and measures it.
+
+    Returns:
+        result (dict): {'wall': seconds for the whole process, 'import': seconds importing the module,
+                        'tick': seconds for the tick, 'max_rss_kb': peak RSS of the process,
+                        'heavy': heavy modules that were loaded, 'imports': -X importtime entries (Python 3.7+)}
+    """
+    with tempfile.TemporaryDirectory(prefix='startup_') as work_dir:
+        tick_code = NOOP_TICKS[module].format(work_dir=work_dir) if tick and module in NOOP_TICKS else ''
+        command = [sys.executable]
+        if sys.version_info >= (3, 7):
+            command += ['-X', 'importtime']
+        command += ['-c', CHILD_SCRIPT.format(module=module, tick=tick_code)]
+        python_path = [SCRIPTS_DIR] + [p for p in os.environ.get('PYTHONPATH', '').split(os.pathsep) if p]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(python_path))
+
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=SCRIPTS_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        wall = time.perf_counter() - start
+    if process.returncode:
+        raise RuntimeError('Importing %s failed:\n%s' % (module, stderr.decode(errors='replace')[-2000:]))
+
+    child = json.loads(stdout.decode().strip().splitlines()[-1])
+    loaded = set(m.split('.')[0] for m in child['modules'])
+    return {
+        'wall': wall,
+        'import': child['import'],
+        'tick': child['tick'],
+        'max_rss_kb': child['max_rss_kb'],
+        'heavy': sorted(m for m in HEAVY_MODULES if m in loaded),
+        'imports': parse_importtime(stderr.decode(errors='replace')),
+    }
+
+
+def run_startup(modules, repeat=5, top=10, max_seconds=1.0, outfile=None):
+    """Measures each entry point repeat times, printing the median and the slowest imports.
+
+    Returns:
+        results (list): history results, one per module, with stage 'startup_<module>'
+        failures (list): reasons the start-up check failed, empty if it passed
+    """
+    results = []
+    failures = []
+    for module in modules:
+        runs = sorted((measure_startup(module) for _ in range(repeat)), key=lambda r: r['wall'])
+        median = runs[len(runs) // 2]
+        print('{module}\twall {wall:.3f}s\timport {imp:.3f}s\ttick {tick:.3f}s\t{rss}KB\theavy: {heavy}'.format(
+            module=module, wall=median['wall'], imp=median['import'], tick=median['tick'], rss=median['max_rss_kb'],
+            heavy=', '.join(median['heavy']) or 'none'), file=outfile)
+        # the entry point's own line includes everything it imports, so leave it out of the breakdown
+        imports = [i for i in median['imports'] if i[3] != module]
+        for cumulative, own, depth, name in sorted(imports, reverse=True)[:top]:
+            print('\t{ms:8.1f}ms\t{name}'.format(ms=cumulative / 1000.0, name=name), file=outfile)
+
+        if median['wall'] > max_seconds:
+            failures.append('%s took %.3fs to start, more than %.3fs' % (module, median['wall'], max_seconds))
+        if median['heavy'] and module in NOOP_TICKS:
+            failures.append('%s loaded %s without work to do' % (module, ', '.join(median['heavy'])))
+        times = [r['wall'] for r in runs]
+        results.append({'stage': 'startup_%s' % module, 'reads': 0, 'seed': 0, 'times': times, 'best': times[0],
+                        'median': median['wall'], 'peak_traced_kb': 0, 'max_rss_kb': median['max_rss_kb']})
+    return results, failures
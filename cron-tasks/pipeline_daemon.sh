@@ -0,0 +1,11 @@
+#!/bin/bash
+
+# Starts pipeline_automation.py as a daemon, unless it is already running. Safe to call from cron every few minutes,
+# which then restarts the daemon if it stops. The daemon touches the heartbeat file itself.
+
+source /home/nanopore/miniconda2/bin/activate 16s-pipeline-env
+
+flock -n /home/nanopore/Desktop/16S_Pipeline/test/pipeline_daemon.lock \
+    python /home/nanopore/test/scripts/pipeline_automation.py --daemon >>/home/nanopore/Desktop/16S_Pipeline/test/stdout 2>&1
+
+conda deactivate
@@ -0,0 +1,11 @@
+#!/bin/bash
+
+# Starts sequencing_automation.py as a daemon, unless it is already running. Safe to call from cron every few
+# minutes, which then restarts the daemon if it stops. The daemon touches the heartbeat file itself.
+
+source /home/grid/miniconda2/bin/activate 16s-pipeline-env
+
+flock -n /data/16S-Pipeline/test/sequencing_daemon.lock \
+    python /opt/scripts/test/scripts/sequencing_automation.py --daemon >>/data/16S-Pipeline/test/stdout 2>&1
+
+conda deactivate
@@ -0,0 +1,113 @@
+import argparse
+import multiprocessing
+import os
+import sys
+from parse_centrifuge import CentrifugeParser, load_reference, print_results as print_cfg_results
+from parse_seqmatch import SeqmatchParser, print_results as print_sqm_results
+
+CFG_SUFFIXES = ('.cfg-output.tsv', '.tsv')
+SQM_SUFFIXES = ('.merged-sqm-results.tsv', '.tsv')
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Collates many Centrifuge or Seqmatch results in one process.')
+    subparsers = parser.add_subparsers(dest='classifier')
+    subparsers.required = True
+
+    cfg = subparsers.add_parser('centrifuge')
+    cfg.add_argument('--tree', action='store', default='/opt/NCBI_RefSeq_16S.tree')  # path to taxonomy tree
+    cfg.add_argument('--names', action='store', default='/opt/NCBI_RefSeq_16S.names')  # path to taxonomy name table
+    cfg.add_argument('--cache', action='store')  # path to compiled reference, defaults to <tree>.cache
+
+    sqm = subparsers.add_parser('seqmatch')
+    sqm.add_argument('--fasta', action='store', default='/opt/NCBI_RefSeq_16S.fasta')  # reference used for analysis
+
+    for sub in (cfg, sqm):
+        sub.add_argument('results', action='store', nargs='*')  # result files to collate
+        sub.add_argument('--manifest', action='store')  # file listing result files, one per line
+        sub.add_argument('--output_dir', action='store')  # defaults to the directory of each result file
+        sub.add_argument('--processes', action='store', type=int, default=1)  # number of files processed at once
+    return parser
+
+
+def read_manifest(manifest):
+    """Returns the result file paths listed in a manifest, ignoring blank lines and lines starting with #."""
+    with open(manifest) as infile:
+        return [l.strip() for l in infile if l.strip() and not l.startswith('#')]
+
+
+def output_path(result_file, suffixes, output_suffix, output_dir=None):
+    """Returns the collated output path for a result file e.g. x.cfg-output.tsv -> x.collated-cfg-results.tsv"""
+    name = os.path.basename(result_file)
+    for suffix in suffixes:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    directory = output_dir if output_dir else os.path.dirname(result_file)
+    return os.path.join(directory, name + output_suffix)
+
+
+# reference data loaded once in the parent and inherited by forked workers
+_reference = dict()
+
+
+def collate_centrifuge(task):
+    result_file, outfile = task
+    if 'cfg_parser' not in _reference:
+        _reference['cfg_parser'] = CentrifugeParser()
+    cfg_parser = _reference['cfg_parser']
+    classified_reads, reads_per_result = cfg_parser.collate_cfg_results(
+        result_file, _reference['tree'], _reference['names'], reference=_reference['ref_data'])
+    with open(outfile, 'w') as output:
+        print_cfg_results(classified_reads, reads_per_result, outfile=output)
+    return outfile
+
+
+def collate_seqmatch(task):
+    result_file, outfile = task
+    sqm_parser = SeqmatchParser(result_file, _reference['fasta'])
+    sqm_parser.ref_dict = _reference['ref_dict']
+    sqm_parser.collate_seqmatch_results()
+    with open(outfile, 'w') as output:
+        print_sqm_results(sqm_parser.classified_reads, sqm_parser.reads_per_species, outfile=output)
+    return outfile
+
+
+def run_batch(collate, tasks, processes):
+    """Runs collate over the (result file, output file) tasks, concurrently if processes > 1."""
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            for outfile in pool.imap(collate, tasks):
+                sys.stderr.write('Written %s\n' % outfile)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            sys.stderr.write('Written %s\n' % collate(task))
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_args()
+    result_files = list(args.results)
+    if args.manifest:
+        result_files.extend(read_manifest(args.manifest))
+    if args.output_dir and not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    if args.classifier == 'centrifuge':
+        _reference['tree'] = args.tree
+        _reference['names'] = args.names
+        _reference['ref_data'] = load_reference(args.tree, args.names, args.cache)
+        batch_tasks = [(f, output_path(f, CFG_SUFFIXES, '.collated-cfg-results.tsv', args.output_dir))
+                       for f in result_files]
+        run_batch(collate_centrifuge, batch_tasks, args.processes)
+    else:
+        ref_parser = SeqmatchParser(None, args.fasta)
+        ref_parser.parse_ref_headers()
+        _reference['fasta'] = args.fasta
+        _reference['ref_dict'] = ref_parser.ref_dict
+        batch_tasks = [(f, output_path(f, SQM_SUFFIXES, '.collated-sqm-results.tsv', args.output_dir))
+                       for f in result_files]
+        run_batch(collate_seqmatch, batch_tasks, args.processes)
@@ -0,0 +1,160 @@
+import argparse
+import sys
+import numpy as np
+from parse_centrifuge import CentrifugeParser, TaxonomyLookup, load_reference
+
+
+class ArrayConsensusEngine(object):
+    """Finds consensus results for batches of Centrifuge hit sets with vectorized NumPy comparisons.
+
+    Each taxonomy identifier is represented as a row of name ids, one column per rank in CentrifugeParser.ranks (0 for
+    a missing rank), plus the index of its most specific rank. A batch of hit sets is stacked into a padded
+    (hit sets x hits x ranks) array and the same decisions as CentrifugeParser.find_taxonomic_match are made for all
+    hit sets at once. Hit sets the array form cannot represent (a hit with none of the ranks) are passed to
+    find_taxonomic_match so the results, including errors, are identical.
+
+    Args:
+        parser (CentrifugeParser): parser whose ranks and fallback classification to use
+        lookup (TaxonomyLookup): lookup for the reference data the hits refer to
+        batch_size (int): number of hit sets to compare at once
+
+    """
+
+    def __init__(self, parser, lookup, batch_size=4096):
+        self.parser = parser
+        self.lookup = lookup
+        self.batch_size = batch_size
+        self.ranks = parser.ranks
+        self.names = [None]
+        self.name_ids = {None: 0}
+        self.rows = dict()
+
+    def _name_id(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.name_ids[name] = name_id
+            self.names.append(name)
+        return name_id
+
+    def _row(self, taxid):
+        """Returns (name ids per rank, most specific rank index) for a taxonomy identifier."""
+        row = self.rows.get(taxid)
+        if row is None:
+            taxonomy = self.lookup.get(taxid)
+            row = ([self._name_id(taxonomy.taxonomy[rank]) for rank in self.ranks],
+                   self.ranks.index(taxonomy.rank) if taxonomy.rank in self.ranks else -1)
+            self.rows[taxid] = row
+        return row
+
+    def classify(self, hit_sets):
+        """Returns the consensus name for each hit set, or None."""
+        results = list()
+        for start in range(0, len(hit_sets), self.batch_size):
+            results.extend(self._classify_batch(hit_sets[start:start + self.batch_size]))
+        return results
+
+    def _classify_batch(self, hit_sets):
+        n_sets = len(hit_sets)
+        n_ranks = len(self.ranks)
+        max_hits = max(len(h) for h in hit_sets) if hit_sets else 0
+        if not n_sets or not max_hits:
+            return [None] * n_sets
+
+        values = np.zeros((n_sets, max_hits, n_ranks), dtype=np.int64)
+        spec = np.full((n_sets, max_hits), n_ranks, dtype=np.int64)
+        valid = np.zeros((n_sets, max_hits), dtype=bool)
+        fallback = np.zeros(n_sets, dtype=bool)
+        for p, hits in enumerate(hit_sets):
+            for h, taxid in enumerate(hits):
+                row, rank_idx = self._row(taxid)
+                values[p, h] = row
+                spec[p, h] = rank_idx
+                valid[p, h] = True
+                if rank_idx < 0:
+                    fallback[p] = True
+
+        n_hits = valid.sum(axis=1)
+        columns = np.arange(n_ranks)
+        truthy = np.array([bool(n) for n in self.names])
+        first = values[:, 0, :]
+
+        # all hits agree with the first hit at each rank
+        agree = np.all((values == first[:, None, :]) | ~valid[:, :, None], axis=1)
+        max_rank = np.where(valid, spec, -1).max(axis=1)
+        min_rank = np.where(valid, spec, n_ranks).min(axis=1)
+
+        # single hit: most specific rank with a name
+        named = truthy[first]
+        fallback |= (n_hits == 1) & ~named.any(axis=1)
+        single = first[np.arange(n_sets), np.argmax(named, axis=1)]
+
+        # low specificity: least specific agreed rank above the starting rank
+        same_rank = max_rank == min_rank
+        start = np.where(same_rank, min_rank, max_rank)
+        above = agree & (columns[None, :] > start[:, None])
+        low = np.where(above.any(axis=1), first[np.arange(n_sets), np.argmax(above, axis=1)], 0)
+
+        # high specificity: work down from the highest rank while hits at or below each rank agree
+        subset = valid[:, :, None] & (spec[:, :, None] <= columns[None, None, :])
+        subset_max = np.where(subset, values, -1).max(axis=1)
+        subset_min = np.where(subset, values, np.iinfo(np.int64).max).min(axis=1)
+        subset_agree = subset.any(axis=1) & (subset_max == subset_min)
+        keep = (subset_agree & (columns[None, :] >= min_rank[:, None])) | (columns[None, :] >= max_rank[:, None])
+        run = np.flip(np.cumprod(np.flip(keep, axis=1), axis=1), axis=1).astype(bool)
+        stop = np.argmax(run, axis=1)
+        clipped_max = np.clip(max_rank, 0, n_ranks - 1)
+        high = np.where(stop >= max_rank, first[np.arange(n_sets), clipped_max],
+                        subset_max[np.arange(n_sets), np.clip(stop, 0, n_ranks - 1)])
+        agree_at_max = agree[np.arange(n_sets), clipped_max]
+
+        name_ids = np.where(n_hits == 1, single,
+                            np.where(same_rank, low, np.where(agree_at_max, high, low)))
+
+        results = list()
+        for p, hits in enumerate(hit_sets):
+            if fallback[p]:
+                results.append(self.parser.find_taxonomic_match(hits, self.lookup))
+            else:
+                results.append(self.names[name_ids[p]])
+        return results
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Checks the array engine gives the same results as the dict engine.')
+    parser.add_argument('--centrifuge', action='store', required=True, nargs='+')  # classification output files
+    parser.add_argument('--tree', action='store', default='/opt/NCBI_RefSeq_16S.tree')
+    parser.add_argument('--names', action='store', default='/opt/NCBI_RefSeq_16S.names')
+    return parser
+
+
+def check_conformance(cfg_results, tree_file, name_file):
+    """Classifies every file with both engines and returns the differences.
+
+    Returns:
+        differences (list): (file, hit set, dict engine result, array engine result) for each disagreement
+    """
+    differences = list()
+    for cfg_result in cfg_results:
+        dict_parser = CentrifugeParser(engine='dict')
+        array_parser = CentrifugeParser(engine='array')
+        lookup = TaxonomyLookup(load_reference(tree_file, name_file), dict_parser.ranks)
+        with open(cfg_result) as infile:
+            next(infile, None)
+            hit_sets = list(set(frozenset(hits) for read, hits in dict_parser.iter_passed_hits(infile)))
+        expected = dict_parser.classify_hit_sets(hit_sets, lookup)
+        actual = array_parser.classify_hit_sets(hit_sets, lookup)
+        for hit_set, dict_result, array_result in zip(hit_sets, expected, actual):
+            if dict_result != array_result:
+                differences.append((cfg_result, sorted(hit_set), dict_result, array_result))
+        sys.stderr.write('%s: %s hit sets compared\n' % (cfg_result, len(hit_sets)))
+    return differences
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_args()
+    engine_differences = check_conformance(args.centrifuge, args.tree, args.names)
+    for diff in engine_differences:
+        print('{file}\t{hits}\t{expected}\t{actual}'.format(
+            file=diff[0], hits=','.join(str(t) for t in diff[1]), expected=diff[2], actual=diff[3]))
+    sys.exit(1 if engine_differences else 0)
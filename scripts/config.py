@@ -2,6 +2,7 @@ time_intervals = [2]
 archive_hours = 72
 setting = 'local'  # "local" or "cloud"
 result_threshold = 1.0
+transfer_streams = 4  # chunks sent at once when copying between the GridION and the workstation
 
 
 class Gridion(object):
@@ -13,15 +14,27 @@ class Gridion(object):
     processed_files = '/data/16S-Pipeline/test/pipeline_input'
     output_files = '/data/16S-Pipeline/test/pipeline_output'
     run_stats = '/home/grid/Desktop/Flongle_QC_Stats.ods'
+    extraction_processes = 4
+    read_indexes = '/data/16S-Pipeline/test/read_indexes'
+    run_state = '/data/16S-Pipeline/test/log_files/run_state.sqlite'
+    concurrent_runs = 2
+    concurrent_transfers = 1
+    max_load = 8.0  # 1 minute load average above which no more runs are started
+    max_io_pressure = 40.0  # % of time stalled on I/O (/proc/pressure/io) above which no more runs are started
+    heartbeat = '/data/16S-Pipeline/test/sequencing_heartbeat.txt'
+    daemon_interval = 60  # maximum seconds between checks for due intervals in daemon mode
 
 
 class Workstation(object):
-    processes = 20
+    processes = 20  # divided between the jobs running at once
+    concurrent_jobs = 4
     username = 'nanopore'
     ip_address = '10.161.19.235'
     pipeline_input = '/home/nanopore/Desktop/16S_Pipeline/test/pipeline_input'
     pipeline_output = '/home/nanopore/Desktop/16S_Pipeline/test/pipeline_output'
     sshpass_file = '/home/nanopore/Desktop/16S_Pipeline/passwd.txt'
+    heartbeat = '/home/nanopore/Desktop/16S_Pipeline/test/pipeline_heartbeat.txt'
+    daemon_interval = 300  # maximum seconds between checks for new input in daemon mode
 
 
 class Dnanexus(object):
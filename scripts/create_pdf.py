@@ -4,7 +4,6 @@ from reportlab.lib import colors
 from reportlab.lib.units import inch, cm
 from reportlab.lib.utils import ImageReader
 import argparse
-from draw_tree import get_example_tree
 
 from reportlab.graphics.shapes import Drawing
 from reportlab.graphics.charts.barcharts import HorizontalBarChart
@@ -204,6 +203,7 @@ def write_results_to_pdf(outfile, seqmatch_output, centrifuge_output, stats_file
     pdf_writer.draw_table(cfg_data, rows_to_highlight=[0], colwidths=[2.8 * inch, 1.1 * inch, 1.1 * inch, 1.1 * inch])
 
     cfg_image = 'centrifuge.png'
+    from draw_tree import get_example_tree  # ete3 loads Qt, so only import it when a tree is drawn
     t, ts = get_example_tree(cfg_tree_input_file)
     t.render(cfg_image, w=1000, tree_style=ts)
 
@@ -1,17 +1,83 @@
 import hashlib
+import json
+import logging
 import os
 import subprocess
 import re
 
 
-def hash_file(filepath):
+HASH_CHUNK_SIZE = 1024 * 1024
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+class HashingWriter(object):
+    """Wraps a binary file handle so an MD5 digest is calculated from the data as it is written.
+
+    Args:
+        handle (file): binary file handle to write to
+    """
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.handle.write(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+def hash_sidecar(filepath):
+    """Returns the path of the file used to cache the MD5 hash of filepath."""
+    return '%s.md5' % filepath
+
+
+def read_cached_hash(filepath):
+    """Returns the cached MD5 hash of filepath, or None if there is no cache or the file has changed since."""
+    try:
+        with open(hash_sidecar(filepath)) as infile:
+            md5, size, mtime = infile.read().split('\t')
+        stat = os.stat(filepath)
+    except (OSError, ValueError):
+        return None
+    if int(size) == stat.st_size and int(mtime) == stat.st_mtime_ns:
+        return md5
+    return None
+
+
+def write_cached_hash(filepath, md5):
+    """Caches the MD5 hash of filepath in a sidecar file, keyed by the file's current size and mtime."""
+    stat = os.stat(filepath)
+    try:
+        with open(hash_sidecar(filepath), 'w') as outfile:
+            outfile.write('%s\t%s\t%s' % (md5, stat.st_size, stat.st_mtime_ns))
+    except OSError:
+        pass
+
+
+def hash_file(filepath, use_cache=True):
     """Creates MD5 hash for checksum.
+
+    The file is read in binary chunks so memory use is bounded. The result is cached in a sidecar file and reused
+    while the file's size and mtime are unchanged.
+
     Args:
         filepath (str): path to file to calculate checksum for.
+        use_cache (bool): whether to read and write the cached hash.
     """
-    with open(filepath) as infile:
-        data = infile.read()
-    md5 = hashlib.md5(data.encode('utf-8')).hexdigest()
+    if use_cache:
+        cached = read_cached_hash(filepath)
+        if cached:
+            return cached
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(HASH_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    md5 = md5.hexdigest()
+    if use_cache:
+        write_cached_hash(filepath, md5)
     return md5
 
 
@@ -30,13 +96,68 @@ def checksum(stats_file, fastq):
         return True
 
 
-def copy_to_remote_location(files, username, ip_address, path, ssh_password_file):
-    for f in files:
-        os.system(
-            'sshpass -f {passwd} scp -r {f} {usr}@{ip}:{path}'.format(
-                passwd=ssh_password_file, f=f, usr=username, ip=ip_address, path=path
-            )
-        )
+def write_manifest(filepath, files):
+    """Writes a manifest listing the name, size and MD5 hash of each file, for the receiver to check them against."""
+    entries = [{'name': os.path.basename(f), 'size': os.path.getsize(f), 'md5': hash_file(f)} for f in files]
+    tmp_file = filepath + '.tmp'
+    with open(tmp_file, 'w') as outfile:
+        json.dump({'files': entries}, outfile, indent=1)
+    os.replace(tmp_file, filepath)
+
+
+def read_manifest(filepath):
+    with open(filepath) as infile:
+        return json.load(infile)['files']
+
+
+def check_manifest(directory, entries):
+    """Checks the files listed in a manifest are present in directory at their recorded sizes.
+
+    The recorded MD5 hashes are cached for the files, so later checksums use them rather than reading the files again.
+    The files were hashed by the sender and only appear once their transfer is complete, so a matching size is taken
+    to mean a matching file.
+
+    Returns:
+        problems (list): descriptions of missing or truncated files, empty if all are present
+    """
+    problems = list()
+    for entry in entries:
+        filepath = os.path.join(directory, entry['name'])
+        if not os.path.exists(filepath):
+            problems.append('%s is missing' % entry['name'])
+        elif os.path.getsize(filepath) != entry['size']:
+            problems.append('%s is %s bytes, expected %s' % (entry['name'], os.path.getsize(filepath), entry['size']))
+        else:
+            write_cached_hash(filepath, entry['md5'])
+    return problems
+
+
+def copy_to_remote_location(files, username, ip_address, path, ssh_password_file, manifest=None, streams=4):
+    """Copies files to a directory on a remote host so that each appears there complete or not at all.
+
+    All the files are sent in one ssh session by transfer.Transfer, which stages, verifies and then renames them into
+    place. A manifest, if given, is renamed last, so once it appears every file it lists is in place. A failed copy can
+    be attempted again and resumes where it stopped.
+
+    Args:
+        files (list): local files or directories to copy
+        username (str): remote user
+        ip_address (str): remote host
+        path (str): remote directory to copy into
+        ssh_password_file (str): file holding the password, for sshpass
+        manifest (str): local manifest file written with write_manifest
+        streams (int): number of chunks sent at once
+
+    Returns:
+        stats (dict): throughput metrics from transfer.Transfer.run, None if the copy failed
+    """
+    from transfer import SSHBackend, send_files  # transfer imports this module
+    backend = SSHBackend(username, ip_address, ssh_password_file)
+    try:
+        return send_files(backend, files, path, manifest=manifest, streams=streams)
+    except (IOError, OSError, RuntimeError):
+        logging.getLogger(__name__).exception('Copying to %s:%s failed.', ip_address, path)
+        return None
 
 
 def compress_directory(indir):
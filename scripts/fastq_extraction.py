@@ -0,0 +1,179 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+
+def read_fastq_records(handle):
+    """Parses 4-line FASTQ records from a binary file handle without building sequence objects.
+
+    Args:
+        handle (file): FASTQ file opened in binary mode
+
+    Yields:
+        read_id (bytes): first word of the header line without the leading '@'
+        offset (int): byte offset of the record from the start of the handle
+        record (bytes): the raw four lines of the record
+        seq_len (int): length of the sequence line
+    """
+    position = 0
+    while True:
+        header = handle.readline()
+        if not header:
+            break
+        offset = position
+        position += len(header)
+        if not header.strip():
+            continue
+        seq = handle.readline()
+        plus = handle.readline()
+        qual = handle.readline()
+        if not qual:
+            raise ValueError('Truncated FASTQ record: %s' % header.strip().decode())
+        position += len(seq) + len(plus) + len(qual)
+        if not qual.endswith(b'\n'):
+            qual += b'\n'
+        read_id = header[1:].split(None, 1)[0]
+        yield read_id, offset, header + seq + plus + qual, len(seq.rstrip())
+
+
+def _route_fastq(fastq, routes, outputs):
+    """Writes each record of one FASTQ whose ID is in routes to outputs[route:], returning (records, bases, found)."""
+    n_outputs = len(outputs)
+    records = [0] * n_outputs
+    bases = [0] * n_outputs
+    found = set()
+    with open(str(fastq), 'rb') as infile:
+        for read_id, offset, record, seq_len in read_fastq_records(infile):
+            first = routes.get(read_id)
+            if first is not None:
+                found.add(read_id)
+                for ix in range(first, n_outputs):
+                    outputs[ix].write(record)
+                    records[ix] += 1
+                    bases[ix] += seq_len
+    return records, bases, found
+
+
+def _encode_routes(routes):
+    return {(r.encode() if isinstance(r, str) else r): first for r, first in routes.items()}
+
+
+def _collate(shard_results, n_outputs):
+    """Reduces per-file (records, bases, found) results into the route_fastq_records totals."""
+    records = [0] * n_outputs
+    bases = [0] * n_outputs
+    found = set()
+    for shard_records, shard_bases, shard_found in shard_results:
+        for ix in range(n_outputs):
+            records[ix] += shard_records[ix]
+            bases[ix] += shard_bases[ix]
+        found.update(shard_found)
+    return {'records': records, 'bases': bases, 'found': set(r.decode() for r in found)}
+
+
+_shared_routes = None
+
+
+def _init_worker(routes):
+    global _shared_routes
+    _shared_routes = routes
+
+
+def _extract_shard(task):
+    fastq, shards = task
+    shard_outputs = [open(shard, 'wb') for shard in shards]
+    try:
+        return _route_fastq(fastq, _shared_routes, shard_outputs)
+    finally:
+        for shard_output in shard_outputs:
+            shard_output.close()
+
+
+def route_fastq_records(fastq_list, routes, outputs, processes=1, shard_directory=None):
+    """Streams records from each FASTQ into one or more outputs in a single pass.
+
+    routes maps each wanted read ID to the index of the first output it belongs to; the record is written to that
+    output and every output after it. This suits nested time intervals, where a read passed by one cutoff is also
+    passed by every later cutoff.
+
+    With more than one process the FASTQ files are spread over a process pool. Each worker filters one FASTQ at a time
+    against the routes (inherited by the workers when they are forked) and writes its matches to one shard per output.
+    Shards are appended to each output in the order of fastq_list, so the result is the same as with one process.
+
+    Args:
+        fastq_list (list): paths to FASTQ files to search
+        routes (dict): read ID to index of the first output the read should be written to
+        outputs (list): binary file handles to write matching records to
+        processes (int): number of worker processes
+        shard_directory (str): directory for temporary shard files, defaults to the system temp directory
+
+    Returns:
+        extracted (dict): {'records': [records per output], 'bases': [sequence length per output],
+                           'found': set of read IDs found}
+    """
+    fastq_list = list(fastq_list)
+    routes = _encode_routes(routes)
+    n_outputs = len(outputs)
+    if processes <= 1 or len(fastq_list) <= 1:
+        return _collate((_route_fastq(fastq, routes, outputs) for fastq in fastq_list), n_outputs)
+
+    shard_dir = tempfile.mkdtemp(prefix='fastq_shards_', dir=shard_directory)
+    try:
+        tasks = [(fastq, [os.path.join(shard_dir, '%s_%s.fastq' % (ix, out_ix)) for out_ix in range(n_outputs)])
+                 for ix, fastq in enumerate(fastq_list)]
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(routes,))
+        try:
+            shard_results = pool.map(_extract_shard, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for out_ix, output in enumerate(outputs):
+            for fastq, shards in tasks:
+                with open(shards[out_ix], 'rb') as shard_input:
+                    shutil.copyfileobj(shard_input, output)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    return _collate(shard_results, n_outputs)
+
+
+def _single_output(extracted):
+    return {'records': extracted['records'][0], 'bases': extracted['bases'][0], 'found': extracted['found']}
+
+
+def extract_fastq_records(fastq_list, read_ids, output):
+    """Streams the records whose IDs are in read_ids from each FASTQ into output.
+
+    Args:
+        fastq_list (list): paths to FASTQ files to search
+        read_ids (iterable): read IDs to extract
+        output (file): binary file handle to write matching records to
+
+    Returns:
+        extracted (dict): {'records': number written, 'bases': total sequence length, 'found': set of read IDs}
+    """
+    return _single_output(route_fastq_records(fastq_list, dict.fromkeys(read_ids, 0), [output]))
+
+
+def extract_fastq_records_parallel(fastq_list, read_ids, output, processes, shard_directory=None):
+    """Parallel version of extract_fastq_records that spreads the FASTQ files over a process pool.
+
+    Args:
+        fastq_list (list): paths to FASTQ files to search
+        read_ids (iterable): read IDs to extract
+        output (file): binary file handle to write matching records to
+        processes (int): number of worker processes
+        shard_directory (str): directory for temporary shard files, defaults to the system temp directory
+
+    Returns:
+        extracted (dict): as for extract_fastq_records
+    """
+    return _single_output(route_fastq_records(
+        fastq_list, dict.fromkeys(read_ids, 0), [output], processes=processes, shard_directory=shard_directory))
+
+
+def calculate_mean_read_length(extracted):
+    """Returns the mean sequence length of the records counted in an extract_fastq_records result."""
+    if not extracted['records']:
+        return 0
+    return extracted['bases'] / extracted['records']
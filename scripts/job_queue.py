@@ -0,0 +1,279 @@
+import argparse
+from contextlib import contextmanager
+import fcntl
+import glob
+import os
+import shutil
+import tempfile
+import time
+from data_transfer import check_manifest, read_manifest, MANIFEST_SUFFIX
+
+JOBS_DIRECTORY = 'jobs'
+FAILED_DIRECTORY = 'failed'
+QUEUE_LOCK = '.queue.lock'
+JOB_LOCK = '.job.lock'
+CLAIM_PREFIX = '.claim-'
+PRIORITY_SUFFIX = '.priority'
+ATTEMPTS_SUFFIX = '.attempts'
+
+
+def input_files(directory, prefix):
+    """Returns a sample's files in directory: the FASTQ and its stats, summary, hash, metrics and queue files."""
+    return [f for f in glob.glob(os.path.join(directory, glob.escape(prefix) + '*'))
+            if os.path.basename(f)[len(prefix):].startswith(('.', '_stats.txt'))]
+
+
+def read_int(filepath, default=0):
+    try:
+        with open(filepath) as infile:
+            return int(infile.read().strip() or default)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def open_lock_file(filepath):
+    # opened read-only: closing a file opened for writing would wake a daemon watching the directory
+    return os.open(filepath, os.O_RDONLY | os.O_CREAT)
+
+
+def try_lock(filepath):
+    """Opens filepath and takes an exclusive flock on it without blocking.
+
+    Returns:
+        lock_fd (int): descriptor holding the lock, or None if another process holds it or the file was removed
+    """
+    try:
+        lock_fd = open_lock_file(filepath)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        os.close(lock_fd)
+        return None
+    return lock_fd
+
+
+class Job(object):
+    """A sample claimed from the queue, with its input files moved into its own working directory.
+
+    The job's lock is held for as long as lock_fd is open in any process, including processes forked after the
+    claim, and is released by the kernel if they all exit. A job directory whose lock is free therefore belongs to a
+    crashed worker.
+
+    Args:
+        prefix (str): sample name, the FASTQ file name without .fastq
+        directory (str): working directory holding the job's input files
+        lock_fd (int): descriptor holding the job's lock
+        failed_directory (str): where the working directory is kept if the job fails
+
+    """
+
+    def __init__(self, prefix, directory, lock_fd, failed_directory):
+        self.prefix = prefix
+        self.directory = directory
+        self.lock_fd = lock_fd
+        self.failed_directory = failed_directory
+
+    @property
+    def fastq(self):
+        return os.path.join(self.directory, self.prefix + '.fastq')
+
+    def check_manifest(self):
+        """Checks the job's files against the manifest it was sent with, if any, and caches their hashes.
+
+        Returns:
+            problems (list): descriptions of missing or truncated files, empty if all are present or there is none
+        """
+        manifest = os.path.join(self.directory, self.prefix + MANIFEST_SUFFIX)
+        if not os.path.exists(manifest):
+            return []
+        return check_manifest(self.directory, read_manifest(manifest))
+
+    def release(self):
+        """Closes this process's handle on the lock, e.g. in the parent once a worker process has been started."""
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    def complete(self):
+        """Removes the working directory and releases the job's slot."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.release()
+
+    def fail(self):
+        """Keeps the working directory in the failed directory for inspection and releases the job's slot."""
+        destination = os.path.join(self.failed_directory, self.prefix)
+        if os.path.exists(destination):
+            destination += '-' + time.strftime('%Y%m%d%H%M%S')
+        os.makedirs(self.failed_directory, exist_ok=True)
+        shutil.move(self.directory, destination)
+        self.release()
+
+
+class JobQueue(object):
+    """Queue of samples waiting in the pipeline input directory, run in up to a fixed number of slots at once.
+
+    Samples arrive as <prefix>.fastq plus its companion files, and from current senders a <prefix>.manifest.json
+    published after them (see data_transfer.copy_to_remote_location). They are taken highest priority first, then oldest
+    first, where priority is the integer in an optional <prefix>.priority file (default 0). A claimed sample's files
+    are moved into jobs/<prefix>/ so concurrent jobs each have their own working directory. All claims and recovery
+    happen under an flock on the queue directory, so any number of processes can share the queue.
+
+    A job directory whose lock is no longer held belongs to a worker that died. Its files are put back in the queue,
+    unless the sample has already been attempted max_attempts times, in which case the directory is moved to failed/.
+
+    Args:
+        queue_directory (str): pipeline input directory the samples arrive in
+        slots (int): maximum number of jobs running at once
+        settle_seconds (float): FASTQs without a manifest modified more recently than this are assumed to still be
+                                arriving
+        max_attempts (int): number of times a sample is started before a crashed job is no longer requeued
+
+    Yields:
+        jobs_directory (str): directory holding the working directories of running jobs
+        failed_directory (str): directory holding the working directories of failed jobs
+    """
+
+    def __init__(self, queue_directory, slots=1, settle_seconds=5, max_attempts=2):
+        self.queue_directory = queue_directory
+        self.slots = max(1, slots)
+        self.settle_seconds = settle_seconds
+        self.max_attempts = max_attempts
+        self.jobs_directory = os.path.join(queue_directory, JOBS_DIRECTORY)
+        self.failed_directory = os.path.join(queue_directory, FAILED_DIRECTORY)
+
+    @contextmanager
+    def _locked(self):
+        lock_fd = open_lock_file(os.path.join(self.queue_directory, QUEUE_LOCK))
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(lock_fd)
+
+    def _arrivals(self):
+        """Yields (prefix, arrival time, seconds until it can be claimed) for each FASTQ in the queue directory.
+
+        A sample sent with a manifest can be claimed as soon as the manifest appears, as the sender renames it into
+        place after the files it lists. A FASTQ without one, from an older sender, is claimed once it has not been
+        modified for settle_seconds.
+        """
+        now = time.time()
+        for fastq in glob.glob(os.path.join(self.queue_directory, '*.fastq')):
+            prefix = os.path.basename(fastq)[:-len('.fastq')]
+            try:
+                arrived = os.path.getmtime(os.path.join(self.queue_directory, prefix + MANIFEST_SUFFIX))
+                yield prefix, arrived, 0
+            except OSError:
+                try:
+                    arrived = os.path.getmtime(fastq)
+                except OSError:
+                    continue
+                yield prefix, arrived, arrived + self.settle_seconds - now
+
+    def pending(self):
+        """Returns the prefixes of samples waiting to run, in the order they will be claimed."""
+        waiting = list()
+        for prefix, arrived, wait in self._arrivals():
+            if wait <= 0:
+                priority = read_int(os.path.join(self.queue_directory, prefix + PRIORITY_SUFFIX))
+                waiting.append((-priority, arrived, prefix))
+        return [prefix for _, _, prefix in sorted(waiting)]
+
+    def settling(self):
+        """Returns the seconds until the next FASTQ without a manifest can be claimed, None if there is none."""
+        waits = [wait for prefix, arrived, wait in self._arrivals() if wait > 0]
+        return min(waits) if waits else None
+
+    def _job_directories(self):
+        if not os.path.isdir(self.jobs_directory):
+            return []
+        return sorted(os.path.join(self.jobs_directory, d) for d in os.listdir(self.jobs_directory)
+                      if not d.startswith(CLAIM_PREFIX))
+
+    def running(self):
+        """Returns the prefixes of jobs that hold their lock, i.e. that a live process is working on."""
+        live = list()
+        for directory in self._job_directories():
+            lock_fd = try_lock(os.path.join(directory, JOB_LOCK))
+            if lock_fd is None:
+                live.append(os.path.basename(directory))
+            else:
+                os.close(lock_fd)
+        return live
+
+    def recover_stale_jobs(self):
+        """Requeues or fails the jobs of workers that died.
+
+        Returns:
+            recovered (list): (prefix, 'requeued' or 'failed') for each stale job
+        """
+        recovered = list()
+        with self._locked():
+            # left by a claim that stopped before moving any files, so they hold nothing but the lock file
+            for claiming in glob.glob(os.path.join(self.jobs_directory, CLAIM_PREFIX + '*')):
+                shutil.rmtree(claiming, ignore_errors=True)
+            for directory in self._job_directories():
+                lock_fd = try_lock(os.path.join(directory, JOB_LOCK))
+                if lock_fd is None:
+                    continue
+                prefix = os.path.basename(directory)
+                job = Job(prefix, directory, lock_fd, self.failed_directory)
+                attempts = read_int(os.path.join(directory, prefix + ATTEMPTS_SUFFIX))
+                requeued_fastq = os.path.join(self.queue_directory, prefix + '.fastq')
+                if attempts >= self.max_attempts or os.path.exists(requeued_fastq):
+                    job.fail()
+                    recovered.append((prefix, 'failed'))
+                else:
+                    for f in input_files(directory, prefix):
+                        os.rename(f, os.path.join(self.queue_directory, os.path.basename(f)))
+                    job.complete()
+                    recovered.append((prefix, 'requeued'))
+        return recovered
+
+    def claim(self):
+        """Moves the next waiting sample into its own working directory, if a slot is free.
+
+        Returns:
+            job (Job): the claimed job, None if all slots are busy or nothing is waiting
+        """
+        with self._locked():
+            if len(self.running()) >= self.slots:
+                return None
+            for prefix in self.pending():
+                directory = os.path.join(self.jobs_directory, prefix)
+                if os.path.exists(directory):
+                    continue  # a job for this sample is still running; leave the new copy queued
+                # lock the job in a private directory first, so no other process probing job locks can hold the
+                # lock at the moment the job appears
+                os.makedirs(self.jobs_directory, exist_ok=True)
+                claiming = tempfile.mkdtemp(prefix=CLAIM_PREFIX, dir=self.jobs_directory)
+                lock_fd = try_lock(os.path.join(claiming, JOB_LOCK))
+                if lock_fd is None:
+                    shutil.rmtree(claiming, ignore_errors=True)
+                    raise RuntimeError('Could not lock the new job directory for %s.' % prefix)
+                os.rename(claiming, directory)
+                attempts_file = os.path.join(self.queue_directory, prefix + ATTEMPTS_SUFFIX)
+                attempts = read_int(attempts_file)
+                with open(attempts_file, 'w') as outfile:
+                    outfile.write('%s\n' % (attempts + 1))
+                for f in input_files(self.queue_directory, prefix):
+                    os.rename(f, os.path.join(directory, os.path.basename(f)))
+                return Job(prefix, directory, lock_fd, self.failed_directory)
+        return None
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Shows the samples waiting, running and failed in a job queue.')
+    parser.add_argument('--queue_directory', action='store', required=True)  # pipeline input directory
+    return parser
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_args()
+    queue = JobQueue(args.queue_directory, settle_seconds=0)
+    print('Waiting:\t%s' % ', '.join(queue.pending()))
+    print('Running:\t%s' % ', '.join(queue.running()))
+    failed = sorted(os.listdir(queue.failed_directory)) if os.path.isdir(queue.failed_directory) else []
+    print('Failed:\t%s' % ', '.join(failed))
@@ -0,0 +1,422 @@
+import argparse
+from collections import defaultdict
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from parse_seqmatch import load_header_index
+
+INDEX_VERSION = 1
+# caps on the working memory of one scoring step: the shared k-mer matrix, and the reference postings expanded at once
+MAX_SCORE_CELLS = 4000000
+MAX_POSTINGS = 20000000
+RESULT_HEADER = 'query name\tmatch seq\torientation\tS_ab score\tunique oligos\tmatch seq description\n'
+
+# A, C, G and T map to 0-3, anything else is 4 and invalidates the k-mers it is part of
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate(['Aa', 'Cc', 'Gg', 'TtUu']):
+    for _base in _bases:
+        _BASE_CODES[ord(_base)] = _code
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Nearest-reference 16S classifier producing SeqMatch-style results.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    build = subparsers.add_parser('build_index')
+    build.add_argument('--fasta', action='store', default='/opt/NCBI_RefSeq_16S.fasta')  # reference sequences
+    build.add_argument('--index_dir', action='store', required=True)
+    build.add_argument('--kmer', action='store', type=int, default=8)
+    build.add_argument('--processes', action='store', type=int, default=1)
+
+    classify = subparsers.add_parser('classify')
+    classify.add_argument('--index_dir', action='store', required=True)
+    classify.add_argument('--reads', action='store', required=True)  # reads in fasta format
+    classify.add_argument('--output', action='store', required=True)  # merged SeqMatch-style result
+    classify.add_argument('--processes', action='store', type=int, default=1)
+
+    concordance = subparsers.add_parser('concordance')
+    concordance.add_argument('--kmer_result', action='store', required=True)
+    concordance.add_argument('--seqmatch_result', action='store', required=True)
+    concordance.add_argument('--fasta', action='store', default='/opt/NCBI_RefSeq_16S.fasta')
+
+    benchmark = subparsers.add_parser('benchmark')
+    benchmark.add_argument('--index_dir', action='store', required=True)
+    benchmark.add_argument('--reads', action='store', required=True)
+    benchmark.add_argument('--fasta', action='store', default='/opt/NCBI_RefSeq_16S.fasta')
+    benchmark.add_argument('--processes', action='store', type=int, default=1)
+    benchmark.add_argument('--seqmatch_result', action='store')  # existing SeqMatch result for the same reads
+    return parser
+
+
+def read_fasta(filepath):
+    """Yields (name, description, sequence) for each record of a fasta file, allowing multi-line sequences."""
+    name = None
+    description = ''
+    seq = []
+    with open(filepath, 'r') as infile:
+        for line in infile:
+            line = line.rstrip('\n')
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, description, ''.join(seq)
+                fields = line[1:].split(None, 1)
+                name = fields[0] if fields else ''
+                description = fields[1] if len(fields) > 1 else ''
+                seq = []
+            elif line:
+                seq.append(line.strip())
+    if name is not None:
+        yield name, description, ''.join(seq)
+
+
+def encode_kmers(seq, k):
+    """Returns the distinct k-mers of a sequence as 2-bit encoded integers, for the sequence and its reverse complement.
+
+    Args:
+        seq (str): nucleotide sequence
+        k (int): k-mer length, at most 16
+
+    Returns:
+        forward (np.ndarray): sorted distinct k-mer codes of seq
+        reverse (np.ndarray): sorted distinct k-mer codes of the reverse complement of seq
+    """
+    codes = _BASE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    n_kmers = len(codes) - k + 1
+    if n_kmers <= 0:
+        empty = np.zeros(0, dtype=np.uint32)
+        return empty, empty
+
+    invalid = np.concatenate([[0], np.cumsum(codes == 4)])
+    valid = (invalid[k:] - invalid[:-k]) == 0
+    bases = np.where(codes == 4, 0, codes).astype(np.uint32)
+    complement = (3 - bases)[::-1]
+
+    forward = np.zeros(n_kmers, dtype=np.uint32)
+    reverse = np.zeros(n_kmers, dtype=np.uint32)
+    for j in range(k):
+        forward |= bases[j:j + n_kmers] << np.uint32(2 * (k - 1 - j))
+        reverse |= complement[j:j + n_kmers] << np.uint32(2 * (k - 1 - j))
+    return np.unique(forward[valid]), np.unique(reverse[valid[::-1]])
+
+
+def _reference_kmers(task):
+    seqs, k = task
+    return [encode_kmers(seq, k)[0] for seq in seqs]
+
+
+class KmerIndex(object):
+    """Memory-mapped index from k-mer to the reference sequences that contain it.
+
+    The index is stored as .npy files in index_dir: the sorted distinct k-mers, offsets into a postings array of
+    reference numbers (compressed sparse row layout) and the number of distinct k-mers in each reference. Reference
+    ids and descriptions are kept in refs.tsv.
+
+    Args:
+        index_dir (str): directory written by KmerIndex.build
+
+    """
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, 'meta.json')) as infile:
+            meta = json.load(infile)
+        if meta.get('version') != INDEX_VERSION:
+            raise ValueError('K-mer index in %s was built by a different version.' % index_dir)
+        self.k = meta['k']
+        self.kmers = np.load(os.path.join(index_dir, 'kmers.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(index_dir, 'offsets.npy'), mmap_mode='r')
+        self.postings = np.load(os.path.join(index_dir, 'postings.npy'), mmap_mode='r')
+        self.ref_kmer_counts = np.load(os.path.join(index_dir, 'ref_kmer_counts.npy'))
+        self.ref_ids = []
+        self.ref_descriptions = []
+        with open(os.path.join(index_dir, 'refs.tsv')) as infile:
+            for line in infile:
+                ref_id, description = line.rstrip('\n').split('\t', 1)
+                self.ref_ids.append(ref_id)
+                self.ref_descriptions.append(description)
+
+    @staticmethod
+    def build(fasta, index_dir, k=8, processes=1):
+        """Builds the index for a reference fasta.
+
+        Args:
+            fasta (str): path to reference fasta
+            index_dir (str): directory to write the index to, created if needed
+            k (int): k-mer length, at most 16
+            processes (int): number of processes used to find reference k-mers
+        """
+        if not 0 < k <= 16:
+            raise ValueError('K-mer length must be between 1 and 16.')
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+        ref_ids = []
+        ref_descriptions = []
+        seqs = []
+        for name, description, seq in read_fasta(fasta):
+            ref_ids.append(name)
+            ref_descriptions.append(description.replace('\t', ' '))
+            seqs.append(seq)
+
+        chunk = max(1, -(-len(seqs) // (processes * 4)))
+        tasks = [(seqs[i:i + chunk], k) for i in range(0, len(seqs), chunk)]
+        if processes > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                chunks = pool.map(_reference_kmers, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            chunks = [_reference_kmers(task) for task in tasks]
+        ref_kmers = [kmers for chunk_kmers in chunks for kmers in chunk_kmers]
+
+        ref_kmer_counts = np.array([len(kmers) for kmers in ref_kmers], dtype=np.int32)
+        all_kmers = np.concatenate(ref_kmers) if ref_kmers else np.zeros(0, dtype=np.uint32)
+        all_refs = np.repeat(np.arange(len(ref_kmers), dtype=np.int32), ref_kmer_counts)
+        order = np.argsort(all_kmers, kind='mergesort')
+        kmers, counts = np.unique(all_kmers[order], return_counts=True)
+        offsets = np.zeros(len(kmers) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        np.save(os.path.join(index_dir, 'kmers.npy'), kmers.astype(np.uint32))
+        np.save(os.path.join(index_dir, 'offsets.npy'), offsets)
+        np.save(os.path.join(index_dir, 'postings.npy'), all_refs[order])
+        np.save(os.path.join(index_dir, 'ref_kmer_counts.npy'), ref_kmer_counts)
+        with open(os.path.join(index_dir, 'refs.tsv'), 'w') as outfile:
+            for ref_id, description in zip(ref_ids, ref_descriptions):
+                outfile.write('%s\t%s\n' % (ref_id, description))
+        with open(os.path.join(index_dir, 'meta.json'), 'w') as outfile:
+            json.dump({'version': INDEX_VERSION, 'k': k, 'references': len(ref_ids)}, outfile)
+
+    def score(self, queries):
+        """Finds the reference sharing the largest fraction of k-mers with each query.
+
+        The score is SeqMatch's S_ab: shared distinct k-mers divided by the distinct k-mers in the smaller of the query
+        and the reference.
+
+        Args:
+            queries (list): sorted distinct k-mer code arrays, one per query
+
+        Returns:
+            best (np.ndarray): index of the best reference for each query
+            s_ab (np.ndarray): score of the best reference
+            shared (np.ndarray): number of k-mers shared with the best reference
+        """
+        n_queries = len(queries)
+        n_refs = len(self.ref_kmer_counts)
+        query_sizes = np.array([len(q) for q in queries], dtype=np.int64)
+        all_queries = np.concatenate(queries) if n_queries else np.zeros(0, dtype=np.uint32)
+        query_idx = np.repeat(np.arange(n_queries), query_sizes)
+
+        if len(self.kmers):
+            positions = np.searchsorted(self.kmers, all_queries)
+            positions = np.minimum(positions, len(self.kmers) - 1)
+            found = self.kmers[positions] == all_queries
+            positions = positions[found]
+            query_idx = query_idx[found]
+        else:
+            positions = query_idx = np.zeros(0, dtype=np.int64)
+
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        ends = np.cumsum(lengths)
+        total = int(ends[-1]) if len(ends) else 0
+
+        # common k-mers have long posting lists, so expand them in steps of at most about MAX_POSTINGS references
+        bounds = np.searchsorted(ends, np.arange(MAX_POSTINGS, total, MAX_POSTINGS), side='right').tolist()
+        shared = np.zeros(n_queries * n_refs, dtype=np.int64)
+        for lo, hi in zip([0] + bounds, bounds + [len(lengths)]):
+            step_lengths = lengths[lo:hi]
+            step_total = int(step_lengths.sum())
+            within = np.arange(step_total) - np.repeat(np.cumsum(step_lengths) - step_lengths, step_lengths)
+            refs = self.postings[np.repeat(starts[lo:hi], step_lengths) + within]
+            pairs = np.repeat(query_idx[lo:hi], step_lengths) * n_refs + refs
+            shared += np.bincount(pairs, minlength=n_queries * n_refs)
+        shared = shared.reshape(n_queries, n_refs)
+        smaller = np.minimum(query_sizes[:, None], self.ref_kmer_counts[None, :])
+        s_ab = shared / np.maximum(smaller, 1)
+        best = s_ab.argmax(axis=1)
+        rows = np.arange(n_queries)
+        return best, s_ab[rows, best], shared[rows, best]
+
+    def classify(self, reads):
+        """Classifies (name, sequence) reads against the index, trying both orientations of each read.
+
+        Returns:
+            results (list): (name, reference id, orientation, S_ab, shared k-mers, description) per read with k-mers
+        """
+        if not len(self.ref_kmer_counts):
+            raise ValueError('K-mer index has no references to classify reads against.')
+        names = []
+        queries = []
+        for name, seq in reads:
+            forward, reverse = encode_kmers(seq, self.k)
+            if len(forward):
+                names.append(name)
+                queries.extend([forward, reverse])
+
+        results = []
+        batch = max(2, (MAX_SCORE_CELLS // len(self.ref_kmer_counts)) // 2 * 2)
+        for start in range(0, len(queries), batch):
+            best, s_ab, shared = self.score(queries[start:start + batch])
+            for pair in range(0, len(best), 2):
+                name = names[(start + pair) // 2]
+                strand = pair if s_ab[pair] >= s_ab[pair + 1] else pair + 1
+                ref = best[strand]
+                results.append((name, self.ref_ids[ref], '+' if strand == pair else '-', s_ab[strand],
+                                shared[strand], self.ref_descriptions[ref]))
+        return results
+
+
+_worker_index = None
+
+
+def _init_worker(index_dir):
+    global _worker_index
+    _worker_index = KmerIndex(index_dir)
+
+
+def _classify_chunk(reads):
+    return _worker_index.classify(reads)
+
+
+def _read_chunks(reads_fasta, size):
+    chunk = []
+    for name, description, seq in read_fasta(reads_fasta):
+        chunk.append((name, seq))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def classify_reads(index_dir, reads_fasta, output, processes=1, chunk_size=2000):
+    """Classifies every read in a fasta file and writes a merged SeqMatch-style result.
+
+    Reads are classified in chunks, spread over a process pool if processes > 1. Workers memory-map the same index
+    files, so the index is shared through the page cache rather than copied.
+
+    Returns:
+        classified (int): number of reads written to output
+    """
+    classified = 0
+    with open(output, 'w') as outfile:
+        outfile.write(RESULT_HEADER)
+        if processes > 1:
+            pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(index_dir,))
+            try:
+                chunk_results = pool.imap(_classify_chunk, _read_chunks(reads_fasta, chunk_size))
+                for results in chunk_results:
+                    classified += write_results(results, outfile)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            index = KmerIndex(index_dir)
+            for reads in _read_chunks(reads_fasta, chunk_size):
+                classified += write_results(index.classify(reads), outfile)
+    return classified
+
+
+def write_results(results, outfile):
+    for name, ref_id, orientation, s_ab, shared, description in results:
+        outfile.write('{name}\t{ref}\t{orientation}\t{score:.3f}\t{shared}\t{description}\n'.format(
+            name=name, ref=ref_id, orientation=orientation, score=s_ab, shared=shared, description=description))
+    return len(results)
+
+
+def read_matches(result_file):
+    """Returns {read name: matched reference id} from a merged SeqMatch-style result, keeping the first match."""
+    matches = dict()
+    with open(result_file) as infile:
+        next(infile, None)
+        for line in infile:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) > 1 and fields[0] not in matches:
+                matches[fields[0]] = fields[1]
+    return matches
+
+
+def concordance_report(kmer_result, seqmatch_result, fasta, outfile=None):
+    """Writes a comparison of k-mer classifier and SeqMatch results for the same reads.
+
+    Reports agreement on the matched reference and on the species the reference belongs to, then reads per species
+    from each classifier.
+    """
+    header_index = load_header_index(fasta)
+    kmer_matches = read_matches(kmer_result)
+    sqm_matches = read_matches(seqmatch_result)
+    both = [r for r in sqm_matches if r in kmer_matches]
+    same_ref = sum(1 for r in both if kmer_matches[r] == sqm_matches[r])
+    same_species = sum(1 for r in both if set(header_index.get(kmer_matches[r], ())) &
+                       set(header_index.get(sqm_matches[r], ())))
+
+    def pct(count, total):
+        return '%.1f' % (100.0 * count / total) if total else '0.0'
+
+    def species_counts(matches):
+        counts = defaultdict(int)
+        for ref_id in matches.values():
+            for species in header_index.get(ref_id, ()):
+                counts[species] += 1
+        return counts
+
+    print('Reads classified by SeqMatch:\t%s' % len(sqm_matches), file=outfile)
+    print('Reads classified by k-mer classifier:\t%s' % len(kmer_matches), file=outfile)
+    print('Reads classified by both:\t%s' % len(both), file=outfile)
+    print('Same reference:\t%s\t%s' % (same_ref, pct(same_ref, len(both))), file=outfile)
+    print('Same species:\t%s\t%s' % (same_species, pct(same_species, len(both))), file=outfile)
+    print('Species\tSeqMatch reads\tK-mer reads', file=outfile)
+    sqm_counts = species_counts(sqm_matches)
+    kmer_counts = species_counts(kmer_matches)
+    for species in sorted(set(sqm_counts) | set(kmer_counts), key=lambda s: -sqm_counts.get(s, 0)):
+        print('%s\t%s\t%s' % (species, sqm_counts.get(species, 0), kmer_counts.get(species, 0)), file=outfile)
+
+
+def benchmark(index_dir, reads_fasta, fasta, processes=1, seqmatch_result=None):
+    """Times the k-mer classifier on a set of reads and, where possible, compares it with SeqMatch.
+
+    SeqMatch is timed on the same reads if SequenceMatch is on the PATH and no existing result is given.
+    """
+    work_dir = tempfile.mkdtemp(prefix='kmer_benchmark_')
+    try:
+        kmer_output = os.path.join(work_dir, 'kmer.merged-sqm-results.tsv')
+        start = time.time()
+        reads = classify_reads(index_dir, reads_fasta, kmer_output, processes=processes)
+        elapsed = time.time() - start
+        print('K-mer classifier:\t%s reads\t%.1f s\t%.0f reads/s' % (reads, elapsed, reads / max(elapsed, 1e-9)))
+
+        if seqmatch_result is None and shutil.which('SequenceMatch'):
+            seqmatch_result = os.path.join(work_dir, 'seqmatch.txt')
+            start = time.time()
+            with open(seqmatch_result, 'w') as outfile:
+                subprocess.check_call(['SequenceMatch', 'seqmatch', '-k', '1', fasta, reads_fasta], stdout=outfile)
+            elapsed = time.time() - start
+            print('SeqMatch:\t%s reads\t%.1f s\t%.0f reads/s' % (reads, elapsed, reads / max(elapsed, 1e-9)))
+
+        if seqmatch_result:
+            concordance_report(kmer_output, seqmatch_result, fasta)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_args()
+    if args.command == 'build_index':
+        KmerIndex.build(args.fasta, args.index_dir, k=args.kmer, processes=args.processes)
+    elif args.command == 'classify':
+        count = classify_reads(args.index_dir, args.reads, args.output, processes=args.processes)
+        sys.stderr.write('Classified %s reads.\n' % count)
+    elif args.command == 'concordance':
+        concordance_report(args.kmer_result, args.seqmatch_result, args.fasta)
+    else:
+        benchmark(args.index_dir, args.reads, args.fasta, processes=args.processes,
+                  seqmatch_result=args.seqmatch_result)
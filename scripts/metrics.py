@@ -0,0 +1,237 @@
+import argparse
+from collections import defaultdict
+from datetime import datetime
+import json
+import os
+import resource
+import threading
+import time
+
+METRICS_SUFFIX = '.metrics.json'
+EXTRACTION_METRICS_SUFFIX = '.extraction-metrics.json'  # written with the FASTQ, merged in by run_pipeline
+IO_FIELDS = ['rchar', 'wchar', 'read_bytes', 'write_bytes']
+
+# spans open in any thread of this process, to tell when the process-wide counters are shared between runs
+_active_spans = set()
+_active_lock = threading.Lock()
+
+
+def read_proc_io():
+    """Returns the I/O counters of this process and its waited-for children from /proc/self/io, or {} if unavailable.
+
+    rchar/wchar count all bytes passed to read/write calls, read_bytes/write_bytes only those that reached storage.
+    """
+    counters = dict()
+    try:
+        with open('/proc/self/io') as infile:
+            for line in infile:
+                name, value = line.split(':')
+                if name in IO_FIELDS:
+                    counters[name] = int(value)
+    except (IOError, OSError, ValueError):
+        return dict()
+    return counters
+
+
+def read_peak_rss():
+    """Returns the peak resident set size of this process in KB, since it started or since reset_peak_rss."""
+    try:
+        with open('/proc/self/status') as infile:
+            for line in infile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss():
+    """Resets the peak RSS reported by read_peak_rss to the current RSS, where the kernel supports it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+    except (IOError, OSError):
+        pass
+
+
+class Span(object):
+    """Context manager recording the resources used by one stage of processing.
+
+    Wall time, CPU time (this process and any child processes waited for during the span, such as Cromwell), peak
+    RSS and bytes read and written are recorded. The span is recorded even if the stage raises, with status 'error'.
+
+    CPU time, I/O and peak RSS are counters of the whole process. When a span overlaps a span in another thread, e.g.
+    while RunScheduler processes several runs at once, its figures include the other thread's work and it is
+    recorded with process_wide set. The peak RSS is then not reset when the span starts, so it is the process's peak
+    since the last reset rather than the span's own.
+
+    Yields:
+        stage (str): stage name
+        metrics (dict): recorded values, filled in when the span exits
+    """
+
+    def __init__(self, recorder, stage):
+        self.recorder = recorder
+        self.stage = stage
+        self.metrics = dict()
+        self.peak_rss = 0
+        self.thread = threading.current_thread()
+        self.process_wide = False
+
+    def __enter__(self):
+        # spans can nest, so carry the outer span's peak so far before resetting the counter
+        if self.recorder.open_spans:
+            outer = self.recorder.open_spans[-1]
+            outer.peak_rss = max(outer.peak_rss, read_peak_rss())
+        self.recorder.open_spans.append(self)
+        with _active_lock:
+            others = [span for span in _active_spans if span.thread is not self.thread]
+            for span in others:
+                span.process_wide = True
+            self.process_wide = bool(others)
+            _active_spans.add(self)
+            # resetting the peak would also wipe it for the spans open in other threads
+            if not others:
+                reset_peak_rss()
+        self._started = datetime.now()
+        self._wall = time.time()
+        self._times = os.times()
+        self._io = read_proc_io()
+        self._children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.time() - self._wall
+        times = os.times()
+        io = read_proc_io()
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        self.peak_rss = max(self.peak_rss, read_peak_rss())
+        with _active_lock:
+            _active_spans.discard(self)
+        self.recorder.open_spans.pop()
+        if self.recorder.open_spans:
+            outer = self.recorder.open_spans[-1]
+            outer.peak_rss = max(outer.peak_rss, self.peak_rss)
+
+        self.metrics = {
+            'stage': self.stage,
+            'started': self._started.strftime('%Y-%m-%d %H:%M:%S'),
+            'status': 'error' if exc_type else 'ok',
+            'wall_seconds': round(wall, 3),
+            'cpu_user_seconds': round(times[0] - self._times[0], 3),
+            'cpu_system_seconds': round(times[1] - self._times[1], 3),
+            'children_cpu_seconds': round(times[2] + times[3] - self._times[2] - self._times[3], 3),
+            'peak_rss_kb': self.peak_rss,
+            # only known if a child process set a new high during the span
+            'children_peak_rss_kb': children_rss if children_rss > self._children_rss else None,
+            'process_wide': self.process_wide,
+        }
+        for field in IO_FIELDS:
+            if field in io and field in self._io:
+                self.metrics[field] = io[field] - self._io[field]
+        self.recorder.spans.append(self.metrics)
+        return False
+
+
+class MetricsRecorder(object):
+    """Collects spans for one run and writes them to a JSON metrics file.
+
+    Args:
+        name (str): run name, e.g. the pipeline prefix
+
+    Yields:
+        spans (list): metrics for each completed span, in completion order
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.created = datetime.now()
+        self.spans = list()
+        self.open_spans = list()
+        self.imported = dict()
+
+    def span(self, stage):
+        return Span(self, stage)
+
+    def add_metrics_file(self, filepath, section):
+        """Includes the spans from another metrics file, e.g. those recorded when the input files were made."""
+        with open(filepath) as infile:
+            self.imported[section] = json.load(infile)
+
+    def to_dict(self):
+        data = {'name': self.name, 'created': self.created.strftime('%Y-%m-%d %H:%M:%S'), 'spans': self.spans}
+        data.update(self.imported)
+        return data
+
+    def write(self, filepath):
+        tmp_file = filepath + '.tmp'
+        with open(tmp_file, 'w') as outfile:
+            json.dump(self.to_dict(), outfile, indent=1)
+        os.replace(tmp_file, filepath)
+
+
+def find_metrics_files(paths):
+    """Returns metrics files from a list of files and directories, searching directories recursively."""
+    metrics_files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                metrics_files.extend(os.path.join(root, f) for f in sorted(files) if f.endswith(METRICS_SUFFIX))
+        else:
+            metrics_files.append(path)
+    return metrics_files
+
+
+def iter_spans(data, section=None):
+    """Yields (section, span) from a metrics file's contents, including imported sections."""
+    for span in data.get('spans', []):
+        yield section, span
+    for key, value in data.items():
+        if isinstance(value, dict) and 'spans' in value:
+            for nested in iter_spans(value, key):
+                yield nested
+
+
+def aggregate_report(metrics_files, outfile=None):
+    """Prints per-stage totals across runs, with the run where each stage was slowest.
+
+    The process-wide column counts spans that overlapped work in another thread, e.g. another run being extracted at
+    the same time: their CPU, peak RSS and I/O figures include that work, so they overstate the stage's own use.
+    """
+    stages = defaultdict(list)
+    for metrics_file in metrics_files:
+        with open(metrics_file) as infile:
+            data = json.load(infile)
+        for section, span in iter_spans(data):
+            stage = '%s/%s' % (section, span['stage']) if section else span['stage']
+            stages[stage].append((data.get('name', metrics_file), span))
+
+    print('Runs:\t%s' % len(metrics_files), file=outfile)
+    print('stage\tcount\ttotal wall s\tmean wall s\tmax wall s\tmean cpu s\tmax peak rss MB\tread MB\twritten MB'
+          '\tprocess-wide\tslowest run', file=outfile)
+    for stage, entries in sorted(stages.items(), key=lambda x: -sum(s['wall_seconds'] for n, s in x[1])):
+        walls = [span['wall_seconds'] for name, span in entries]
+        cpus = [span['cpu_user_seconds'] + span['cpu_system_seconds'] + span['children_cpu_seconds']
+                for name, span in entries]
+        peak = max(max(span['peak_rss_kb'], span.get('children_peak_rss_kb') or 0) for name, span in entries)
+        read = sum(span.get('rchar', 0) for name, span in entries)
+        written = sum(span.get('wchar', 0) for name, span in entries)
+        shared = sum(1 for name, span in entries if span.get('process_wide'))
+        slowest = max(entries, key=lambda e: e[1]['wall_seconds'])[0]
+        print('{stage}\t{count}\t{total:.1f}\t{mean:.1f}\t{max:.1f}\t{cpu:.1f}\t{rss:.0f}\t{read:.0f}\t{written:.0f}'
+              '\t{shared}\t{slowest}'.format(stage=stage, count=len(entries), total=sum(walls),
+                                             mean=sum(walls) / len(walls), max=max(walls), cpu=sum(cpus) / len(cpus),
+                                             rss=peak / 1024.0, read=read / 1048576.0, written=written / 1048576.0,
+                                             shared=shared, slowest=slowest),
+              file=outfile)
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Reports stage metrics aggregated across runs.')
+    parser.add_argument('paths', action='store', nargs='+')  # metrics files or directories to search for them
+    return parser
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_args()
+    aggregate_report(find_metrics_files(args.paths))
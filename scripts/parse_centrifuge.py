@@ -1,14 +1,27 @@
 __credits__ = "Theory of finding correct taxonomy match taken from Natalie Groves' supernatant script."
 
-from collections import defaultdict
+from array import array
+from collections import Counter, OrderedDict, defaultdict
+from itertools import groupby
+from operator import itemgetter
 import argparse
+import multiprocessing
+import os
+import pickle
+import sys
 
 
 def argument_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--centrifuge', action='store')  # path to centrifuge classification output file
+    parser.add_argument('--centrifuge', action='store')  # path to centrifuge classification output file, - for stdin
     parser.add_argument('--tree', action='store', default='/opt/NCBI_RefSeq_16S.tree')  # path to taxonomy tree
     parser.add_argument('--names', action='store', default='/opt/NCBI_RefSeq_16S.names')  # path to taxonomy name table
+    parser.add_argument('--cache', action='store')  # path to compiled reference, defaults to <tree>.cache
+    parser.add_argument('--build_cache', action='store_true')  # compile the reference and exit
+    parser.add_argument('--cache_stats', action='store_true')  # print consensus cache statistics to stderr
+    parser.add_argument('--processes', action='store', type=int, default=1)  # processes used to classify reads
+    parser.add_argument('--stream', action='store_true')  # input has each read's lines together, group as it is read
+    parser.add_argument('--engine', action='store', choices=['dict', 'array'], default='dict')  # consensus engine
     return parser
 
 
@@ -29,12 +42,9 @@ class Taxonomy(object):
         self.taxonomy = dict()
         self.rank = None
 
-    def get_taxonomy(self, ref_data, tax_ranks):
-        # Check taxonomy identifier is valid
-        if self.taxid not in ref_data:
-            raise KeyError('Taxonomy identifier %s not found in reference data.' % self.taxid)
-
-        # Check reference taxonomy contains a root
+    @staticmethod
+    def find_root(ref_data):
+        """Returns the taxonomy identifier of the root node in the reference data."""
         root = None
         for key, value in ref_data.items():
             if value['name'] == 'root':
@@ -42,6 +52,16 @@ class Taxonomy(object):
                 break
         if not root:
             raise ValueError("Reference taxonomy must contain a root.")
+        return root
+
+    def get_taxonomy(self, ref_data, tax_ranks, root=None):
+        # Check taxonomy identifier is valid
+        if self.taxid not in ref_data:
+            raise KeyError('Taxonomy identifier %s not found in reference data.' % self.taxid)
+
+        # Check reference taxonomy contains a root
+        if root is None:
+            root = self.find_root(ref_data)
 
         # Find result at each rank until reach the top of the taxonomy
         rank = ref_data[self.taxid]['rank']
@@ -63,19 +83,232 @@ class Taxonomy(object):
                 self.taxonomy[rank] = None
 
 
+class TaxonomyLookup(object):
+    """Returns Taxonomy objects for identifiers in one set of reference data, resolving each lineage only once.
+
+    The root is found on the first lookup and every Taxonomy is memoized, so repeated hits cost a dictionary lookup
+    instead of a walk up the tree. The returned objects are shared and should not be modified.
+
+    Args:
+        ref_data (dict): reference dictionary produced from CentrifugeParser.parse_ref_data
+        tax_ranks (list): ranks to restrict each taxonomy to
+
+    """
+
+    def __init__(self, ref_data, tax_ranks):
+        self.ref_data = ref_data
+        self.tax_ranks = tax_ranks
+        self.root = None
+        self.lineages = dict()
+
+    def get(self, taxid):
+        taxid = int(taxid)
+        tax_obj = self.lineages.get(taxid)
+        if tax_obj is None:
+            if self.root is None:
+                self.root = Taxonomy.find_root(self.ref_data)
+            tax_obj = Taxonomy(taxid)
+            tax_obj.get_taxonomy(self.ref_data, self.tax_ranks, root=self.root)
+            self.lineages[taxid] = tax_obj
+        return tax_obj
+
+
+class ReferenceTables(object):
+    """Compact, array-backed copy of the taxonomy tree and name table.
+
+    Supports the lookups Taxonomy makes on the ref_data dictionary from CentrifugeParser.parse_ref_data, and can be
+    saved to and loaded from a compiled cache file in a single read.
+
+    Args:
+        taxids (array): taxonomy identifiers in tree file order
+        parents (array): parent identifier of each node
+        rank_ids (array): index into rank_names for each node
+        rank_names (list): distinct rank names
+        names (list): name of each node, None if missing from the name table
+        name_order (array): node indices in name table order
+
+    """
+    version = 1
+
+    def __init__(self, taxids, parents, rank_ids, rank_names, names, name_order):
+        self.taxids = taxids
+        self.parents = parents
+        self.rank_ids = rank_ids
+        self.rank_names = rank_names
+        self.names = names
+        self.name_order = name_order
+        self.index = dict(zip(taxids, range(len(taxids))))
+
+    @classmethod
+    def from_files(cls, tree_file, name_file):
+        """Parses the taxonomy tree and name table files."""
+        taxids = array('q')
+        parents = array('q')
+        rank_ids = array('H')
+        rank_names = []
+        rank_index = {}
+        with open(tree_file, 'r') as infile:
+            for line in infile:
+                entry = line.strip().split('\t')
+                rank = entry[4]
+                if rank not in rank_index:
+                    rank_index[rank] = len(rank_names)
+                    rank_names.append(rank)
+                taxids.append(int(entry[0]))
+                parents.append(int(entry[2]))
+                rank_ids.append(rank_index[rank])
+
+        index = dict(zip(taxids, range(len(taxids))))
+        names = [None] * len(taxids)
+        name_order = array('q')
+        with open(name_file, 'r') as infile:
+            for line in infile:
+                entry = line.strip().split('\t')
+                ix = index.get(int(entry[0]))
+                if ix is not None:
+                    names[ix] = entry[2]
+                    name_order.append(ix)
+        return cls(taxids, parents, rank_ids, rank_names, names, name_order)
+
+    @staticmethod
+    def signature(tree_file, name_file):
+        """Size and modification time of the source files, used to detect a stale cache."""
+        return tuple((os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in (tree_file, name_file))
+
+    def save(self, cache_file, signature):
+        data = {
+            'version': self.version, 'signature': signature, 'taxids': self.taxids, 'parents': self.parents,
+            'rank_ids': self.rank_ids, 'rank_names': self.rank_names, 'names': self.names,
+            'name_order': self.name_order
+        }
+        temp_file = '%s.%s.tmp' % (cache_file, os.getpid())
+        with open(temp_file, 'wb') as outfile:
+            pickle.dump(data, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, cache_file)
+
+    @classmethod
+    def load(cls, cache_file, signature):
+        """Returns the cached tables, or None if the cache is missing or was built from different source files."""
+        try:
+            with open(cache_file, 'rb') as infile:
+                data = pickle.load(infile)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if data.get('version') != cls.version or data.get('signature') != signature:
+            return None
+        return cls(data['taxids'], data['parents'], data['rank_ids'], data['rank_names'], data['names'],
+                   data['name_order'])
+
+    def __contains__(self, taxid):
+        return taxid in self.index
+
+    def __getitem__(self, taxid):
+        ix = self.index[taxid]
+        return {'parent': self.parents[ix], 'rank': self.rank_names[self.rank_ids[ix]], 'name': self.names[ix]}
+
+    def items(self):
+        for taxid in self.taxids:
+            yield taxid, self[taxid]
+
+    def name_info(self):
+        """Returns the name_info dictionary from CentrifugeParser.parse_ref_data e.g. {'E.coli': {'rank': 'species',
+        'taxid': 562}}."""
+        name_info = dict()
+        for ix in self.name_order:
+            name_info[self.names[ix]] = {'rank': self.rank_names[self.rank_ids[ix]], 'taxid': self.taxids[ix]}
+        return name_info
+
+
+def load_reference(tree_file, name_file, cache_file=None):
+    """Returns ReferenceTables for the tree and name files, using the compiled cache when it is up to date.
+
+    A stale or missing cache is rebuilt from the source files and saved if the cache location is writable.
+
+    Args:
+        tree_file (str): path to taxonomy tree file
+        name_file (str): path to taxonomy name table file
+        cache_file (str): path to compiled reference, defaults to <tree_file>.cache
+
+    Returns:
+        tables (ReferenceTables): compiled reference data
+    """
+    if cache_file is None:
+        cache_file = '%s.cache' % tree_file
+    signature = ReferenceTables.signature(tree_file, name_file)
+    tables = ReferenceTables.load(cache_file, signature)
+    if tables is None:
+        tables = ReferenceTables.from_files(tree_file, name_file)
+        try:
+            tables.save(cache_file, signature)
+        except OSError:
+            pass
+    return tables
+
+
+class ConsensusCache(object):
+    """Least recently used cache of consensus results keyed by the frozenset of passed taxonomy ids for a read.
+
+    Args:
+        max_size (int): maximum number of hit sets to keep.
+
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, hit_set, classify):
+        """Returns the cached result for hit_set, calling classify(hit_set) to create it if needed."""
+        if hit_set in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(hit_set)
+            return self.entries[hit_set]
+        self.misses += 1
+        result = classify(hit_set)
+        self.entries[hit_set] = result
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return result
+
+    def __contains__(self, hit_set):
+        return hit_set in self.entries
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries),
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
 class CentrifugeParser(object):
     """Parses the Centrifuge classification output to find number of reads per taxonomy match.
 
     Args:
         qscore_threshold (int): threshold for including/excluding reads. Default is 300.
         taxonomy_ranks (list): ranks to restrict results to.
+        cache_size (int): maximum number of distinct hit sets to keep consensus results for.
+        engine (str): 'dict' to compare lineages one hit set at a time, or 'array' to use the vectorized NumPy engine
+            in centrifuge_lca.
+
+    Yields:
+        stats (dict): read and cache counts for the last collated sample, e.g. {'reads': 1000, 'hit_sets': 25, ...}
 
     """
-    def __init__(self, qscore_threshold=300, taxonomy_ranks=None):
+    def __init__(self, qscore_threshold=300, taxonomy_ranks=None, cache_size=100000, engine='dict'):
         if taxonomy_ranks is None:
             taxonomy_ranks = ['species', 'genus', 'family', 'order', 'class', 'phylum', 'superkingdom']
+        if engine not in ('dict', 'array'):
+            raise ValueError('Unknown consensus engine: %s' % engine)
         self.qthresh = qscore_threshold
         self.ranks = taxonomy_ranks
+        self.engine = engine
+        self.consensus_cache = ConsensusCache(cache_size)
+        self.cache_reference = None
+        self.stats = dict()
 
     @staticmethod
     def read_file(filepath):
@@ -142,6 +375,32 @@ class CentrifugeParser(object):
 
         return passed_hits
 
+    def iter_passed_hits(self, lines, stream=False):
+        """Groups Centrifuge output lines by read and yields the hits that pass the filter.
+
+        By default all lines are grouped before anything is yielded, so a read's hits may be anywhere in the file. With
+        stream, consecutive lines are grouped as they are read, so only one read's hits are held in memory at a time;
+        this relies on the input keeping each read's lines together, as Centrifuge itself writes them.
+
+        Args:
+            lines (iterable): lines of the centrifuge classification file, excluding the header
+            stream (bool): group consecutive lines only
+
+        Yields:
+            read_id (str): read identifier
+            hits (set): taxonomy ids of the passed hits e.g. {123, 234, 345}
+        """
+        results = (line.strip().split('\t') for line in lines if line.strip())
+        if not stream:
+            for read_id, hits in self.find_passed_hits_per_read(results).items():
+                yield read_id, hits
+            return
+
+        for read_id, read_results in groupby(results, key=itemgetter(0)):
+            passed_hits = self.find_passed_hits_per_read(read_results)
+            if read_id in passed_hits:
+                yield read_id, passed_hits[read_id]
+
     def match_low_specificity(self, taxonomy_list, rank_idx):
         """Works up the taxonomy tree until all hits are in agreement.
 
@@ -203,18 +462,18 @@ class CentrifugeParser(object):
 
         Args:
             hits (list): taxonomy ids for hits e.g. [123, 234, 345]
-            ref_data (dict): reference dictionary produced from parse_ref_data
+            ref_data (dict or TaxonomyLookup): reference dictionary produced from parse_ref_data, or a lookup built
+                from it to reuse lineages between calls
 
         Returns:
             name (str): name of hit e.g. 'E.coli'
         """
 
+        if not isinstance(ref_data, TaxonomyLookup):
+            ref_data = TaxonomyLookup(ref_data, self.ranks)
+
         # Get taxonomy info for each hit
-        taxonomy_list = []
-        for taxid in hits:
-            tax_obj = Taxonomy(taxid)
-            tax_obj.get_taxonomy(ref_data, self.ranks)
-            taxonomy_list.append(tax_obj)
+        taxonomy_list = [ref_data.get(taxid) for taxid in hits]
 
         # If no hits, return None
         if len(taxonomy_list) == 0:
@@ -250,49 +509,160 @@ class CentrifugeParser(object):
 
         return name
 
-    def collate_cfg_results(self, cfg_result, tree_file, name_file):
+    def classify_uncached(self, hit_sets, lookup):
+        """Finds the consensus result for each hit set with the selected engine, bypassing the cache."""
+        if self.engine == 'array':
+            from centrifuge_lca import ArrayConsensusEngine
+            return ArrayConsensusEngine(self, lookup).classify(hit_sets)
+        return [self.find_taxonomic_match(hits, lookup) for hits in hit_sets]
+
+    def classify_hit_sets(self, hit_sets, lookup, processes=1):
+        """Finds the consensus result for each hit set, using the consensus cache and optionally a process pool.
+
+        Hit sets missing from the cache are split into batches over the pool. Workers inherit the reference data when
+        they are forked rather than receiving a copy per batch.
+
+        Args:
+            hit_sets (list): frozensets of taxonomy ids
+            lookup (TaxonomyLookup): lookup for the reference data the hits refer to
+            processes (int): number of processes to classify with
+
+        Returns:
+            results (list): consensus name for each hit set, or None
+        """
+        results = [None] * len(hit_sets)
+        missing = list()
+        for ix, hit_set in enumerate(hit_sets):
+            if hit_set in self.consensus_cache:
+                results[ix] = self.consensus_cache.get(hit_set, None)
+            else:
+                missing.append(ix)
+
+        if processes > 1 and len(missing) > 1:
+            batch_size = max(1, -(-len(missing) // (processes * 4)))
+            batches = [[hit_sets[ix] for ix in missing[i:i + batch_size]]
+                       for i in range(0, len(missing), batch_size)]
+            pool = multiprocessing.Pool(
+                processes, initializer=_init_classifier, initargs=(self.ranks, lookup.ref_data, self.engine))
+            try:
+                batch_results = pool.map(_classify_batch, batches)
+            finally:
+                pool.close()
+                pool.join()
+            classified = [name for batch in batch_results for name in batch]
+        else:
+            classified = self.classify_uncached([hit_sets[ix] for ix in missing], lookup)
+
+        for ix, name in zip(missing, classified):
+            results[ix] = name
+            self.consensus_cache.get(hit_sets[ix], lambda hits: name)
+        return results
+
+    def collate_cfg_results(self, cfg_result, tree_file, name_file, cache_file=None, processes=1, reference=None,
+                            stream=False):
         """Converts raw Centrifuge result into a dictionary of reads per result.
 
         Args:
-            cfg_result (str): path to file containing raw Centrifuge classification output.
+            cfg_result (str): path to file containing raw Centrifuge classification output, or - to read from stdin.
             tree_file (str): path to file containing taxonomy tree used to generate Centrifuge database.
             name_file (str): path to file containing name table used to generate Centrifuge database.
+            cache_file (str): path to compiled copy of the tree and name table, see load_reference.
+            processes (int): number of processes used to classify reads.
+            reference (ReferenceTables): reference already loaded from tree_file and name_file, to reuse between files.
+            stream (bool): group each read's lines as they are read, see iter_passed_hits. Always used for stdin.
 
         Returns:
             classified_count (int): total number of classified reads
             results (dict): e.g. key is (result, rank) and value is number of reads e.g. {('Ecoli', 'species'): 5}
         """
 
-        tree_data = self.read_file(tree_file)
-        name_data = self.read_file(name_file)
-        ref_data, name_info = self.parse_ref_data(tree_data, name_data)
-
-        all_hits = self.read_file(cfg_result)[1:]
-        passed_hits = self.find_passed_hits_per_read(all_hits)
+        ref_data = reference if reference is not None else load_reference(tree_file, name_file, cache_file)
+        name_info = ref_data.name_info()
+        lookup = TaxonomyLookup(ref_data, self.ranks)
+
+        # cached consensus results are only valid for the reference they were made with
+        signature = ReferenceTables.signature(tree_file, name_file)
+        if self.cache_reference != signature:
+            self.consensus_cache.clear()
+            self.cache_reference = signature
+
+        # count reads per distinct set of hits so each set is only classified once
+        cfg_file = sys.stdin if cfg_result == '-' else open(cfg_result, 'r')
+        try:
+            next(cfg_file, None)  # header
+            passed_hits = self.iter_passed_hits(cfg_file, stream=stream or cfg_file is sys.stdin)
+            hit_set_counts = Counter(frozenset(hits) for read, hits in passed_hits)
+        finally:
+            if cfg_file is not sys.stdin:
+                cfg_file.close()
+
+        cache_hits = self.consensus_cache.hits
+        cache_misses = self.consensus_cache.misses
         classified_count = 0
         results = defaultdict(int)
-        for read, hits in passed_hits.items():
-            result = self.find_taxonomic_match(hits, ref_data)
+        hit_sets = list(hit_set_counts)
+        for hit_set, result in zip(hit_sets, self.classify_hit_sets(hit_sets, lookup, processes)):
+            reads = hit_set_counts[hit_set]
             if result:
                 rank = name_info[result]['rank']
                 taxid = name_info[result]['taxid']
-                classified_count += 1
-                results[(result, taxid, rank)] += 1
+                classified_count += reads
+                results[(result, taxid, rank)] += reads
+
+        self.stats = {
+            'reads': sum(hit_set_counts.values()),
+            'hit_sets': len(hit_set_counts),
+            'cache_hits': self.consensus_cache.hits - cache_hits,
+            'cache_misses': self.consensus_cache.misses - cache_misses,
+        }
 
         return classified_count, results
 
 
-def print_results(read_count, result_dict):
-    """Prints results to stdout."""
-    print('Classified reads:\t%s' % read_count)
+_worker_parser = None
+_worker_lookup = None
+
+
+def _init_classifier(taxonomy_ranks, ref_data, engine):
+    global _worker_parser, _worker_lookup
+    _worker_parser = CentrifugeParser(taxonomy_ranks=taxonomy_ranks, engine=engine)
+    _worker_lookup = TaxonomyLookup(ref_data, taxonomy_ranks)
+
+
+def _classify_batch(hit_sets):
+    return _worker_parser.classify_uncached(hit_sets, _worker_lookup)
+
+
+def print_results(read_count, result_dict, outfile=None):
+    """Prints results to stdout, or to outfile if given."""
+    print('Classified reads:\t%s' % read_count, file=outfile)
     for k, v in result_dict.items():
         fraction = float(v) / float(read_count)
         pct = '%.1f' % (fraction * 100)
-        print('{result}\t{taxid}\t{rank}\t{reads}\t{pct}'.format(result=k[0], taxid=k[1], rank=k[2], reads=v, pct=pct))
+        print('{result}\t{taxid}\t{rank}\t{reads}\t{pct}'.format(result=k[0], taxid=k[1], rank=k[2], reads=v, pct=pct),
+              file=outfile)
+
+
+def print_cache_stats(stats):
+    """Prints consensus cache statistics for one sample to stderr."""
+    reuse = 1 - float(stats['hit_sets']) / stats['reads'] if stats['reads'] else 0.0
+    sys.stderr.write('Reads with hits:\t%s\n' % stats['reads'])
+    sys.stderr.write('Distinct hit sets:\t%s\n' % stats['hit_sets'])
+    sys.stderr.write('Reads reusing a consensus:\t%.1f%%\n' % (reuse * 100))
+    sys.stderr.write('Consensus cache hits:\t%s\n' % stats['cache_hits'])
+    sys.stderr.write('Consensus cache misses:\t%s\n' % stats['cache_misses'])
 
 
 if __name__ == '__main__':
     args = argument_parser().parse_args()
-    cfg_parser = CentrifugeParser()
-    classified_reads, reads_per_result = cfg_parser.collate_cfg_results(args.centrifuge, args.tree, args.names)
-    print_results(classified_reads, reads_per_result)
+    if args.build_cache:
+        cache = args.cache or '%s.cache' % args.tree
+        ReferenceTables.from_files(args.tree, args.names).save(cache, ReferenceTables.signature(args.tree, args.names))
+    else:
+        cfg_parser = CentrifugeParser(engine=args.engine)
+        classified_reads, reads_per_result = cfg_parser.collate_cfg_results(
+            args.centrifuge, args.tree, args.names, cache_file=args.cache, processes=args.processes,
+            stream=args.stream)
+        print_results(classified_reads, reads_per_result)
+        if args.cache_stats:
+            print_cache_stats(cfg_parser.stats)
@@ -1,71 +1,143 @@
 import re
 from collections import defaultdict
 import argparse
+import os
+import pickle
+
+HEADER_REGEX = re.compile(r'>([A-Z{2}_[0-9.]+)\s(([A-Z\[][A-Za-z\]]+\s){1,2}[a-z]+)')
+HEADER_INDEX_VERSION = 1
 
 
 def argument_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--seqmatch', action='store', required=True)  # path to merged Seqmatch result
+    parser.add_argument('--seqmatch', action='store')  # path to merged Seqmatch result
     parser.add_argument('--fasta', action='store', default='/opt/NCBI_RefSeq_16S.fasta')  # reference used for analysis
+    parser.add_argument('--index', action='store')  # path to header index, defaults to <fasta>.headers
+    parser.add_argument('--build_index', action='store_true')  # build the header index and exit
     return parser
 
 
+def fasta_signature(fasta):
+    """Size and modification time of the reference fasta, used to detect a stale header index."""
+    stat = os.stat(fasta)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def build_header_index(fasta):
+    """Scans the headers of the reference fasta, skipping sequence lines, to map each refseq id to its species.
+
+    Args:
+        fasta (str): path to reference fasta
+
+    Returns:
+        header_index (dict): refseq id to tuple of distinct species names e.g. {'NR_024570.1': ('Escherichia coli',)}
+    """
+    species_per_id = defaultdict(list)
+    with open(fasta, 'r') as infile:
+        for line in infile:
+            if not line.startswith('>'):
+                continue
+            for refseq_id, species_name, _ in HEADER_REGEX.findall(line):
+                if species_name not in species_per_id[refseq_id]:
+                    species_per_id[refseq_id].append(species_name)
+    return {refseq_id: tuple(species) for refseq_id, species in species_per_id.items()}
+
+
+def save_header_index(header_index, index_file, signature):
+    temp_file = '%s.%s.tmp' % (index_file, os.getpid())
+    with open(temp_file, 'wb') as outfile:
+        pickle.dump({'version': HEADER_INDEX_VERSION, 'signature': signature, 'headers': header_index}, outfile,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file, index_file)
+
+
+def load_header_index(fasta, index_file=None):
+    """Returns the header index for the reference fasta, rebuilding and saving it if it is missing or stale.
+
+    Args:
+        fasta (str): path to reference fasta
+        index_file (str): path to header index, defaults to <fasta>.headers
+
+    Returns:
+        header_index (dict): see build_header_index
+    """
+    if index_file is None:
+        index_file = '%s.headers' % fasta
+    signature = fasta_signature(fasta)
+    try:
+        with open(index_file, 'rb') as infile:
+            data = pickle.load(infile)
+        if data.get('version') == HEADER_INDEX_VERSION and data.get('signature') == signature:
+            return data['headers']
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    header_index = build_header_index(fasta)
+    try:
+        save_header_index(header_index, index_file, signature)
+    except OSError:
+        pass
+    return header_index
+
+
 class SeqmatchParser(object):
     """Parses seqmatch results into a dictionary of reads per species.
 
     Args:
         seqmatch_result_file (str): path to merged Seqmatch result
         refseq_fasta_file (str): reference fasta used for Seqmatch analysis
+        header_index_file (str): path to cached header index, defaults to <refseq_fasta_file>.headers
 
     Yields:
-        ref_dict (dict): fasta file converted into dict where key is transcript id and value is species name.
+        ref_dict (dict): fasta headers converted into dict where key is transcript id and value is a tuple of species.
         classified_reads (int): total number of classified reads
         reads_per_species (dict): key is species name and value is number of reads, e.g. {'Ecoli': 5}
 
     """
-    def __init__(self, seqmatch_result_file, refseq_fasta_file):
+    def __init__(self, seqmatch_result_file, refseq_fasta_file, header_index_file=None):
         self.sqm_result = seqmatch_result_file
         self.ref = refseq_fasta_file
+        self.ref_index = header_index_file
         self.ref_dict = defaultdict(list)
         self.classified_reads = 0
         self.reads_per_species = defaultdict(int)
 
     def parse_ref_headers(self):
-        """Parses the headers of the reference fasta to populate ref_dict."""
-        with open(self.ref, 'r') as infile:
-            headers = [l for l in infile.readlines() if l.startswith('>')]
-        for header in headers:
-            regex = re.findall(r'>([A-Z{2}_[0-9.]+)\s(([A-Z\[][A-Za-z\]]+\s){1,2}[a-z]+)', header)
-            if regex:
-                for transcript in regex:
-                    refseq_id = transcript[0]
-                    species_name = transcript[1]
-                    self.ref_dict[refseq_id].append(species_name)
+        """Populates ref_dict from the cached header index of the reference fasta."""
+        self.ref_dict = load_header_index(self.ref, self.ref_index)
 
     def collate_seqmatch_results(self):
-        """Parses Seqmatch result to populate reads_per_species."""
-        self.parse_ref_headers()
+        """Parses Seqmatch result to populate reads_per_species. ref_dict is only populated if it is empty, so a
+        parsed reference can be shared between parsers."""
+        if not self.ref_dict:
+            self.parse_ref_headers()
+        self.classified_reads = 0
         with open(self.sqm_result, 'r') as infile:
-            results = [l.strip().split('\t') for l in infile.readlines()][1:]
-        self.classified_reads = len(results)
-        for result in results:
-            refseq_id = result[1]
-            species_matches = set(self.ref_dict[refseq_id])
-            for species in species_matches:
-                self.reads_per_species[species] += 1
-
-
-def print_results(read_count, result_dict):
-    """Prints results to stdout."""
-    print('Classified reads:\t%s' % read_count)
+            next(infile, None)  # header
+            for line in infile:
+                refseq_id = line.strip().split('\t')[1]
+                self.classified_reads += 1
+                for species in self.ref_dict.get(refseq_id, ()):
+                    self.reads_per_species[species] += 1
+
+
+def print_results(read_count, result_dict, outfile=None):
+    """Prints results to stdout, or to outfile if given."""
+    print('Classified reads:\t%s' % read_count, file=outfile)
     for k, v in result_dict.items():
         fraction = float(v) / float(read_count)
         pct = '%.1f' % (fraction * 100)
-        print('{species}\t{reads}\t{pct}'.format(species=k, reads=v, pct=pct))
+        print('{species}\t{reads}\t{pct}'.format(species=k, reads=v, pct=pct), file=outfile)
 
 
 if __name__ == '__main__':
-    args = argument_parser().parse_args()
-    sqm_parser = SeqmatchParser(args.seqmatch, args.fasta)
-    sqm_parser.collate_seqmatch_results()
-    print_results(sqm_parser.classified_reads, sqm_parser.reads_per_species)
+    arg_parser = argument_parser()
+    args = arg_parser.parse_args()
+    if args.build_index:
+        index = args.index or '%s.headers' % args.fasta
+        save_header_index(build_header_index(args.fasta), index, fasta_signature(args.fasta))
+    elif args.seqmatch:
+        sqm_parser = SeqmatchParser(args.seqmatch, args.fasta, args.index)
+        sqm_parser.collate_seqmatch_results()
+        print_results(sqm_parser.classified_reads, sqm_parser.reads_per_species)
+    else:
+        arg_parser.error('--seqmatch is required unless --build_index is given')
@@ -1,76 +1,135 @@
+import argparse
 import config
-import glob
+import multiprocessing
 import os
 import shutil
-import sys
-import time
-from pathlib import Path
-from pipeline_wrapper import run_pipeline
-
-
-def get_first_fastq():
-    first_fastq = None
-    fastqs = [(x, os.path.getmtime(x)) for x in glob.glob('*.fastq')]
-    print(fastqs)
-    if fastqs:
-        fastqs.sort(key=lambda x: x[1])
-        first_fastq = fastqs[0][0]
-    return first_fastq
-
-
-def wait(fastq, secs):
-    current_time = time.time()
-    mod_time = os.path.getmtime(fastq)
-    while mod_time + secs >= current_time:
-        time.sleep(secs)
-        current_time = time.time()
-        mod_time = os.path.getmtime(fastq)
-
-
-def main():
-    os.chdir(config.Workstation.pipeline_input)
-    indication_file = 'process_running'
-
-    if os.path.exists(indication_file):
-        sys.exit()
+from data_transfer import copy_to_remote_location
+from job_queue import JobQueue
+from watcher import run_daemon
+
+JOB_POLL_SECONDS = 30  # how often the daemon checks for finished jobs while any are running
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--daemon', action='store_true')  # keep running and process files as they arrive
+    return parser.parse_args()
+
+
+def job_queue():
+    return JobQueue(config.Workstation.pipeline_input, slots=config.Workstation.concurrent_jobs)
+
+
+def run_job(job, processes):
+    """Runs the pipeline on a claimed sample in its working directory and copies the results back.
+
+    Called in a worker process, which holds the job's lock until it exits.
+    """
+    # imported here as pipeline_wrapper loads the PDF libraries, which most ticks do not need
+    from pipeline_wrapper import run_pipeline
+
+    os.chdir(job.directory)
+    prefix = job.prefix
+    problems = job.check_manifest()
+    if problems:
+        print('%s: %s' % (prefix, '; '.join(problems)))
+        job.fail()
+        return
+
+    run_pipeline(
+        prefix=prefix,
+        fastq=prefix + '.fastq',
+        summary=prefix + '.sequencing_summary',
+        stats=prefix + '_stats.txt',
+        threshold=config.result_threshold,
+        processes=processes
+    )
+
+    if not os.path.isdir(prefix):
+        job.fail()
+        return
+
+    copied = copy_to_remote_location(
+        files=[prefix],
+        username=config.Gridion.username,
+        ip_address=config.Gridion.ip_address,
+        path=config.Gridion.output_files,
+        ssh_password_file=config.Workstation.sshpass_file,
+        streams=config.transfer_streams
+    )
+    shutil.move(prefix, config.Workstation.pipeline_output)
+    if copied:
+        print('%s: results copied to %s (%.1f MB/s).' % (prefix, config.Gridion.output_files, copied['mb_per_second']))
+        job.complete()
     else:
-        
-        fastq = get_first_fastq()
-
-        if fastq:
-            Path(indication_file).touch()
-
-            wait(fastq, 5)
-
-            prefix = fastq.replace('.fastq', '')
-            stats_file = prefix + '_stats.txt'
-            summary_file = prefix + '.sequencing_summary'
-
-            run_pipeline(
-                prefix=prefix,
-                fastq=fastq,
-                summary=summary_file,
-                stats=stats_file,
-                threshold=config.result_threshold,
-                processes=config.processes
-            )
-
-            if os.path.isdir(prefix):
-                destination = '{usr}@{ip}:{path}'.format(
-                    usr=config.Gridion.username, ip=config.Gridion.ip_address, path=config.Gridion.output_files
-                )
-                os.system('sshpass -f {pwd} scp -r {d} {dest}'.format(
-                    pwd=config.Workstation.sshpass_file,
-                    d=prefix,
-                    dest=destination
-                ))
-                shutil.move(prefix, config.Workstation.pipeline_output)
-
-            os.remove(indication_file)
-
-        else:
-            sys.exit()
+        # the results are kept in pipeline_output and the sample's input in the queue's failed directory
+        print('%s: copying results to %s failed, results kept in %s.' % (
+            prefix, config.Gridion.output_files, config.Workstation.pipeline_output))
+        job.fail()
+
+
+def start_waiting_jobs(workers):
+    """Starts a worker process for each waiting sample while there are free slots.
+
+    Workstation.processes is divided between the jobs that will be running once the waiting samples are started, at
+    most one per slot, so a sample that arrives on its own gets all the cores rather than a fixed share of them.
+
+    Args:
+        workers (dict): running worker processes by sample, updated in place
+
+    Returns:
+        started (list): samples started
+    """
+    queue = job_queue()
+    for prefix, action in queue.recover_stale_jobs():
+        print('%s: worker stopped unexpectedly, %s' % (prefix, action))
+    jobs = min(queue.slots, len(queue.running()) + len(queue.pending()))
+    processes = max(1, config.Workstation.processes // max(1, jobs))
+    started = list()
+    job = queue.claim()
+    while job is not None:
+        worker = multiprocessing.Process(target=run_job, args=(job, processes), name=job.prefix)
+        worker.start()
+        job.release()  # the worker holds the lock from here
+        workers[job.prefix] = worker
+        started.append(job.prefix)
+        job = queue.claim()
+    return started
+
+
+def reap_workers(workers):
+    """Removes finished workers from workers, returning the samples they ran."""
+    finished = [prefix for prefix, worker in workers.items() if not worker.is_alive()]
+    for prefix in finished:
+        workers.pop(prefix).join()
+    return finished
+
+
+def process_waiting_jobs(workers):
+    """One daemon pass: collects finished workers and fills free slots.
+
+    Returns:
+        next_due (float): seconds until the queue should be checked again, for running workers or FASTQs that are
+                          still arriving, None if there are neither
+    """
+    reap_workers(workers)
+    start_waiting_jobs(workers)
+    waits = [w for w in [JOB_POLL_SECONDS if workers else None, job_queue().settling()] if w is not None]
+    return min(waits) if waits else None
+
+
+def main(daemon=False):
+    workers = dict()
+    if daemon:
+        run_daemon(lambda: process_waiting_jobs(workers), [config.Workstation.pipeline_input],
+                   config.Workstation.heartbeat, config.Workstation.daemon_interval)
+    else:
+        # each cron invocation fills the slots that are free and waits for its own jobs
+        start_waiting_jobs(workers)
+        for worker in workers.values():
+            worker.join()
 
 
 if __name__ == '__main__':
-    main()
+    args = argument_parser()
+    main(daemon=args.daemon)
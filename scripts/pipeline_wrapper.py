@@ -9,8 +9,8 @@ from collections import defaultdict
 import re
 import shutil
 from subprocess import Popen, PIPE
-from data_transfer import checksum
-from create_pdf import write_results_to_pdf
+from data_transfer import checksum, hash_sidecar
+from metrics import MetricsRecorder, METRICS_SUFFIX, EXTRACTION_METRICS_SUFFIX
 # note: "run_pipeline" function also requires installed module "cromwell"
 
 
@@ -30,14 +30,19 @@ def argument_parser():
 
 
 def create_log_file(filename):
-    """Creates logger object for writing to log file."""
+    """Creates logger object for writing to log file, detaching the file of any earlier run in this process."""
+    logger = logging.getLogger('main_logger')
+    for existing in list(logger.handlers):
+        if isinstance(existing, logging.FileHandler):
+            logger.removeHandler(existing)
+            existing.close()
+
     formatter = logging.Formatter(
         '%(levelname)s\t%(asctime)s\t%(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )
     handler = logging.FileHandler(filename)
     handler.setFormatter(formatter)
-    logger = logging.getLogger('main_logger')
     logger.setLevel(logging.DEBUG)
     logger.addHandler(handler)
     return logger
@@ -133,6 +138,8 @@ def run_pipeline(prefix, fastq, summary, stats, threshold, processes, sqm_ref=No
     """
     log_filename = 'Pipeline-%s-%s.log' % (datetime.now().strftime('%Y%m%d'), prefix)
     main_logger = create_log_file(log_filename)
+    metrics = MetricsRecorder(prefix)
+    metrics_filename = prefix + METRICS_SUFFIX
 
     try:
         main_logger.info('Processing started.')
@@ -140,36 +147,39 @@ def run_pipeline(prefix, fastq, summary, stats, threshold, processes, sqm_ref=No
         pipeline_script = os.path.join(Path(__file__).resolve().parents[0], 'pipeline.wdl')
 
         # check fastq MD5
-        md5_match = checksum(stats, fastq)
+        with metrics.span('md5_check'):
+            md5_match = checksum(stats, fastq)
         if md5_match:
             main_logger.info('MD5 values match.')
         else:
             raise RuntimeError('MD5 values do not match.')
 
         # create cromwell inputs.json file
-        wdl_parameters = {
-            'PipelineWorkflow.fastq': fastq,
-            'PipelineWorkflow.summary': summary,
-            'PipelineWorkflow.quality_stats': stats,
-            'PipelineWorkflow.threshold': threshold,
-            'PipelineWorkflow.processes': processes,
-        }
-        if sqm_ref:
-            wdl_parameters['PipelineWorkflow.seqmatch_ref_database'] = sqm_ref
-        if cfg_idx:
-            wdl_parameters['PipelineWorkflow.cfg_prefix'] = '%s*' % cfg_idx
-        if cfg_tree:
-            wdl_parameters['PipelineWorkflow.cfg_tree'] = cfg_tree
-        if cfg_names:
-            wdl_parameters['PipelineWorkflow.cfg_names'] = cfg_names
-        with open(inputs_file, 'w') as inputs_json:
-            json.dump(wdl_parameters, inputs_json)
+        with metrics.span('inputs_json'):
+            wdl_parameters = {
+                'PipelineWorkflow.fastq': fastq,
+                'PipelineWorkflow.summary': summary,
+                'PipelineWorkflow.quality_stats': stats,
+                'PipelineWorkflow.threshold': threshold,
+                'PipelineWorkflow.processes': processes,
+            }
+            if sqm_ref:
+                wdl_parameters['PipelineWorkflow.seqmatch_ref_database'] = sqm_ref
+            if cfg_idx:
+                wdl_parameters['PipelineWorkflow.cfg_prefix'] = '%s*' % cfg_idx
+            if cfg_tree:
+                wdl_parameters['PipelineWorkflow.cfg_tree'] = cfg_tree
+            if cfg_names:
+                wdl_parameters['PipelineWorkflow.cfg_names'] = cfg_names
+            with open(inputs_file, 'w') as inputs_json:
+                json.dump(wdl_parameters, inputs_json)
 
         # run the pipeline using subprocess
         main_logger.info('Pipeline starting.')
         cromwell_cmd = ['cromwell', 'run', '-i', inputs_file, pipeline_script]
-        sp = Popen(cromwell_cmd, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = sp.communicate()
+        with metrics.span('cromwell'):
+            sp = Popen(cromwell_cmd, stdout=PIPE, stderr=PIPE)
+            stdout, stderr = sp.communicate()
         main_logger.info('Pipeline complete.')
 
         # save cromwell stdout to file
@@ -184,22 +194,35 @@ def run_pipeline(prefix, fastq, summary, stats, threshold, processes, sqm_ref=No
         cfg_outputs = list(Path('.').rglob('*collated-cfg-results.tsv'))
         if sqm_outputs and cfg_outputs:
             print(pdf_report, sqm_outputs[0], cfg_outputs[0], stats, threshold)
-            write_results_to_pdf(outfile=pdf_report, seqmatch_output=sqm_outputs[0], centrifuge_output=cfg_outputs[0],
-                                 stats_file=stats, threshold=threshold)
+            with metrics.span('pdf_report'):
+                from create_pdf import write_results_to_pdf  # reportlab and ete3 are only needed here
+                write_results_to_pdf(outfile=pdf_report, seqmatch_output=sqm_outputs[0],
+                                     centrifuge_output=cfg_outputs[0], stats_file=stats, threshold=threshold)
 
         # tidy up working files
-        tidy_up_pipeline_files(
-            prefix=prefix, input_files=[fastq, summary, stats, inputs_file], log_files=[pipeline_log_filename])
+        input_files = [fastq, summary, stats, inputs_file]
+        if os.path.exists(hash_sidecar(fastq)):
+            input_files.append(hash_sidecar(fastq))
+        log_files = [pipeline_log_filename]
+        extraction_metrics = prefix + EXTRACTION_METRICS_SUFFIX
+        if os.path.exists(extraction_metrics):
+            metrics.add_metrics_file(extraction_metrics, 'extraction')
+            log_files.append(extraction_metrics)
+        with metrics.span('tidy_up'):
+            tidy_up_pipeline_files(prefix=prefix, input_files=input_files, log_files=log_files)
 
         main_logger.info('Processing completed.')
 
     except Exception:
         main_logger.error('Exception occurred.', exc_info=True)
 
+    metrics_dir = '.'
     if os.path.isdir(prefix):
         for d in os.listdir(prefix):
             if 'logs' in d:
                 shutil.move(log_filename, os.path.join(prefix, d))
+                metrics_dir = os.path.join(prefix, d)
+    metrics.write(os.path.join(metrics_dir, metrics_filename))
 
 
 if __name__ == '__main__':
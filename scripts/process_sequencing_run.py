@@ -1,17 +1,20 @@
 import argparse
-from Bio import SeqIO
+import bisect
 from datetime import datetime
 import os
-from pyexcel_ods3 import get_data
 from pathlib import Path
 import re
 import sys
 import time
 #sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
-from data_transfer import hash_file
+from data_transfer import HashingWriter, write_cached_hash
+from fastq_extraction import route_fastq_records, calculate_mean_read_length
+from metrics import MetricsRecorder, EXTRACTION_METRICS_SUFFIX
+from read_index import ReadIndex
 
 
 def get_recorded_stats_for_run(stats_file, runid):
+    from pyexcel_ods3 import get_data  # deferred so that ticks with nothing due do not load pyexcel
     stats = dict()
     lines = get_data(stats_file)['Sheet1']
     headers = lines[0]
@@ -25,144 +28,335 @@ def get_recorded_stats_for_run(stats_file, runid):
     return stats
 
 
+START_TIME_REGEX = re.compile(br'exp_start_time.{0,1024}?([\d-]{10}T[\d:]{8}Z)', re.DOTALL)
+START_TIME_WINDOW = 16 * 1024 * 1024
+START_TIME_CHUNK = 1024 * 1024
+RUN_START_CACHE = '.run_start_time'
+_run_start_times = dict()
+
+
+def _to_timestamp(date_text):
+    return datetime.strptime(date_text, '%Y-%m-%dT%H:%M:%SZ').strftime('%s')
+
+
+def _import_h5py():
+    """Imports h5py on first use, returning None if it is not installed."""
+    try:
+        import h5py
+    except ImportError:
+        return None
+    return h5py
+
+
+def read_start_time_attribute(fast5):
+    """Reads exp_start_time from the tracking_id attributes of a fast5 file using h5py, if it is installed."""
+    h5py = _import_h5py()
+    if h5py is None:
+        return None
+    try:
+        with h5py.File(str(fast5), 'r') as f5:
+            if 'UniqueGlobalKey/tracking_id' in f5:
+                tracking_id = f5['UniqueGlobalKey/tracking_id']
+            else:
+                read_group = next((key for key in f5 if key.startswith('read_')), None)
+                if read_group is None:
+                    return None
+                tracking_id = f5[read_group]['tracking_id']
+            value = tracking_id.attrs.get('exp_start_time')
+    except (OSError, KeyError):
+        return None
+    if isinstance(value, bytes):
+        value = value.decode()
+    date_regex = re.search(r'[\d-]{10}T[\d:]{8}Z', str(value))
+    return date_regex.group(0) if date_regex else None
+
+
+def search_start_time(fast5, window=START_TIME_WINDOW):
+    """Searches the first window bytes of a fast5 file for exp_start_time, one chunk at a time."""
+    overlap = 2048
+    tail = b''
+    with open(str(fast5), 'rb') as infile:
+        read = 0
+        while read < window:
+            chunk = infile.read(START_TIME_CHUNK)
+            if not chunk:
+                break
+            read += len(chunk)
+            buffer = tail + chunk
+            date_regex = START_TIME_REGEX.search(buffer)
+            if date_regex:
+                return date_regex.group(1).decode()
+            tail = buffer[-overlap:]
+    return None
+
+
 def get_run_start_time(fast5):
+    """Returns the experiment start time of a fast5 file as a timestamp string.
+
+    The tracking_id attributes are read directly when h5py is available, otherwise a bounded window at the start of
+    the file is searched. The whole file is only searched if neither finds the start time.
+    """
+    date_text = read_start_time_attribute(fast5) or search_start_time(fast5)
+    if date_text:
+        return _to_timestamp(date_text)
     with open(str(fast5), 'rb') as infile:
         data = str(infile.read())
     date_regex = re.search(r'exp_start_time.*?([\d-]{10}T[\d:]{8}Z)', data)
-    timestamp = datetime.strptime(date_regex.group(1), '%Y-%m-%dT%H:%M:%SZ').strftime('%s')
-    return timestamp
+    return _to_timestamp(date_regex.group(1))
+
+
+def find_run_start_time(run_directory):
+    """Returns the start time of a run, cached in the run directory so it is only looked up once per run."""
+    key = os.path.abspath(run_directory)
+    if key in _run_start_times:
+        return _run_start_times[key]
+    cache_file = os.path.join(run_directory, RUN_START_CACHE)
+    try:
+        with open(cache_file) as infile:
+            start_time = infile.read().strip()
+    except OSError:
+        fast5_file = next(Path(run_directory).rglob('*_0.fast5'), None)
+        if fast5_file is None:
+            raise RuntimeError('No first FAST5 file (*_0.fast5) in %s to read the run start time from.' % run_directory)
+        start_time = get_run_start_time(fast5_file)
+        try:
+            with open(cache_file, 'w') as outfile:
+                outfile.write(start_time)
+        except OSError:
+            pass
+    _run_start_times[key] = start_time
+    return start_time
 
 
 def hour_to_seconds(hour):
     return float(hour * 3600)
 
 
-def find_reads(summary_file, seconds):
+SUMMARY_FIELDS = ['read_id', 'passes_filtering', 'start_time', 'mean_qscore_template']
+
+
+def scan_summary(summary_file, fields, copies=()):
+    """Streams the sequencing summary, yielding only the requested columns for each read.
+
+    Column positions are resolved once from the header, so memory use does not grow with the number of reads.
+
+    Args:
+        summary_file (str): path to sequencing_summary.txt
+        fields (list): column names to extract e.g. ['read_id', 'start_time']
+        copies (list): text file handles to copy every line of the summary to as it is read
+
+    Yields:
+        values (tuple): values for one read in the same order as fields
+    """
     with open(str(summary_file)) as infile:
-        content = infile.read()
-    lines = [l.split() for l in content.split('\n')]
-    header = lines[0]
-    read_lines = lines[1:]
-    qscores = list()
+        header_line = infile.readline()
+        for copy in copies:
+            copy.write(header_line)
+        header = header_line.split()
+        columns = [header.index(field) for field in fields]
+        for line in infile:
+            for copy in copies:
+                copy.write(line)
+            row = line.split()
+            try:
+                yield tuple(row[column] for column in columns)
+            except IndexError:
+                pass
+
+
+def find_reads(summary_file, seconds):
+    qscore_total = 0
+    passed_reads = 0
     total_reads = 0
     read_ids_at_time = list()
-    for read in read_lines:
-        try:
-            read_id = read[header.index('read_id')]
-            pass_filter = read[header.index('passes_filtering')]
-            start_time = float(read[header.index('start_time')])
-            qscore = float(read[header.index('mean_qscore_template')])
-            if start_time <= float(seconds):
-                total_reads += 1
-                if pass_filter == 'TRUE':
-                    read_ids_at_time.append(read_id)
-                    qscores.append(qscore)
-        except IndexError:
-            pass
-    mean_qscore = sum(qscores) / len(qscores)
-    return {'reads': read_ids_at_time, 'mean_qscore': mean_qscore, 'total_reads': total_reads,
-            'summary_content': content}
+    for read_id, pass_filter, start_time, qscore in scan_summary(summary_file, SUMMARY_FIELDS):
+        start_time = float(start_time)
+        qscore = float(qscore)
+        if start_time <= float(seconds):
+            total_reads += 1
+            if pass_filter == 'TRUE':
+                read_ids_at_time.append(read_id)
+                qscore_total += qscore
+                passed_reads += 1
+    mean_qscore = qscore_total / passed_reads
+    return {'reads': read_ids_at_time, 'mean_qscore': mean_qscore, 'total_reads': total_reads}
 
 
-def extract_fastq_records(fastq_list, read_ids):
-    output_records = list()
-    for fastq in fastq_list:
-        for record in SeqIO.parse(str(fastq), 'fastq'):
-            if record.id in read_ids:
-                output_records.append(record)
-    return output_records
+def find_reads_at_times(summary_file, seconds_list, copies=()):
+    """Finds the reads passed at each of several time cutoffs with a single pass over the sequencing summary.
 
+    Args:
+        summary_file (str): path to sequencing_summary.txt
+        seconds_list (list): time cutoffs in seconds, in ascending order
+        copies (list): text file handles to copy the summary to, see scan_summary
 
-def calculate_mean_read_length(fastq_records):
-    read_lengths = list()
-    for record in fastq_records:
-        seq_len = len(str(record.seq))
-        read_lengths.append(seq_len)
-    return sum(read_lengths) / len(read_lengths)
+    Returns:
+        intervals (list): for each cutoff, {'total_reads': int, 'passed_reads': int, 'mean_qscore': float}
+        routes (dict): passed read ID to the index of the first cutoff it falls within
+    """
+    n_cutoffs = len(seconds_list)
+    cutoffs = [float(s) for s in seconds_list]
+    total_reads = [0] * n_cutoffs
+    passed_reads = [0] * n_cutoffs
+    qscore_totals = [0] * n_cutoffs
+    routes = dict()
+    for read_id, pass_filter, start_time, qscore in scan_summary(summary_file, SUMMARY_FIELDS, copies):
+        start_time = float(start_time)
+        qscore = float(qscore)
+        first = bisect.bisect_left(cutoffs, start_time)
+        if first < n_cutoffs:
+            if pass_filter == 'TRUE':
+                routes[read_id] = first
+            # accumulate every interval in read order so each mean matches find_reads exactly
+            for ix in range(first, n_cutoffs):
+                total_reads[ix] += 1
+                if pass_filter == 'TRUE':
+                    passed_reads[ix] += 1
+                    qscore_totals[ix] += qscore
 
+    intervals = list()
+    for ix in range(n_cutoffs):
+        mean_qscore = qscore_totals[ix] / passed_reads[ix] if passed_reads[ix] else 0
+        intervals.append({'total_reads': total_reads[ix], 'passed_reads': passed_reads[ix], 'mean_qscore': mean_qscore})
+    return intervals, routes
 
-def process_run_at_time(run_directory, recorded_stats, hour, output_location):
-    seq_data = dict()
+
+def interval_files(run_directory, hour, output_location):
+    """Returns the paths of the FASTQ, stats, sequencing summary and metrics files written for an interval of a run."""
     full_run_name = os.path.split(run_directory.strip('/'))[-1]
+    fastq_filepath = os.path.join(output_location, '{run}_{time}hr.fastq'.format(run=full_run_name, time=hour))
+    return {
+        'fastq': fastq_filepath,
+        'stats': fastq_filepath.replace('.fastq', '_stats.txt'),
+        'summary': fastq_filepath.replace('.fastq', '.sequencing_summary'),
+        'metrics': fastq_filepath.replace('.fastq', EXTRACTION_METRICS_SUFFIX),
+    }
+
+
+def process_run_at_intervals(run_directory, recorded_stats, hours, output_location, processes=1,
+                             index_directory=None):
+    """Creates the FASTQ, sequencing summary and stats files for several time intervals of a run at once.
+
+    The sequencing summary and FASTQ files are each read once, with every read routed to all interval files whose
+    cutoff it falls within. Intervals the run has not reached yet are skipped.
+
+    Args:
+        run_directory (str): sequencing run output directory
+        recorded_stats (str): path to spreadsheet of recorded run stats
+        hours (list): time intervals in hours
+        output_location (str): directory to write the output files to
+        processes (int): number of processes used to read the FASTQ files
+        index_directory (str): directory holding the persistent read index, if one should be used
 
-    time_text = '%shr' % hour
+    Returns:
+        seq_data (dict): hour to the seq_data for that interval, an empty dict if the interval was not reached
+    """
+    seq_data = {hour: dict() for hour in hours}
+    full_run_name = os.path.split(run_directory.strip('/'))[-1]
 
-    fast5_file = list(Path(run_directory).rglob('*_0.fast5'))[0]
-    start_time = get_run_start_time(fast5_file)
+    start_time = find_run_start_time(run_directory)
 
     current_time = time.time()
-    interval_in_secs = hour_to_seconds(hour)
-    reached_interval = current_time >= float(start_time) + interval_in_secs
+    reached = [h for h in sorted(hours) if current_time >= float(start_time) + hour_to_seconds(h)]
+    if not reached:
+        return seq_data
 
     run_id = re.search(r'FGD\d+', full_run_name).group(0)
-    stats = get_recorded_stats_for_run(recorded_stats, run_id)
-    stats['Run Name'] = full_run_name
-    stats['Datetime'] = start_time
-
-    if reached_interval:
-
-        Path(os.path.join(run_directory, time_text + '_started')).touch()
-
-        # output files
-        fastq_filename = '{run}_{time}.fastq'.format(run=full_run_name, time=time_text)
-        fastq_filepath = os.path.join(output_location, fastq_filename)
-        stats_filepath = fastq_filepath.replace('.fastq', '_stats.txt')
-        summary_filepath = fastq_filepath.replace('.fastq', '.sequencing_summary')
-        seq_data['files'] = {'fastq': fastq_filepath, 'stats': stats_filepath, 'summary': summary_filepath}
-
-        summary_file = list(Path(run_directory).rglob('*sequencing_summary.txt'))[0]
-        reads_dict = find_reads(summary_file, interval_in_secs)
-        read_ids_at_interval = reads_dict['reads']
-        mean_qscore = reads_dict['mean_qscore']
-        total_reads = reads_dict['total_reads']
-        summary_content = reads_dict['summary_content']
-        seq_data['total_reads'] = total_reads
-
-        with open(summary_filepath, 'w') as summary_output:
-            summary_output.write(summary_content)
-
-        if read_ids_at_interval:
-            all_fastqs = list(Path(run_directory).rglob('*.fastq'))
-            fastq_records = extract_fastq_records(all_fastqs, read_ids_at_interval)
-            mean_read_length = calculate_mean_read_length(fastq_records)
-            fastq_record_ids = set([record.id for record in fastq_records])
-            if len(fastq_record_ids) != len(read_ids_at_interval):
-                missing_reads = [r for r in read_ids_at_interval if r not in fastq_record_ids]
-                if missing_reads:
-                    seq_data['missing_reads'] = missing_reads
-            SeqIO.write(fastq_records, fastq_filepath, 'fastq')
-        else:
-            mean_read_length = 0
-            Path(fastq_filepath).touch()
-
-        stats['Total reads'] = total_reads
-        stats['Analysed reads'] = len(read_ids_at_interval)
-        stats['Mean read length'] = mean_read_length
-        stats['Mean Q-score'] = mean_qscore
-        stats['MD5'] = hash_file(fastq_filepath)
-        stats['Hour'] = hour
-
-        with open(stats_filepath, 'w') as stats_output:
-            for k, v in stats.items():
-                stats_output.write('{metric}\t{score}\n'.format(metric=k, score=v))
+    run_stats = get_recorded_stats_for_run(recorded_stats, run_id)
+    run_stats['Run Name'] = full_run_name
+    run_stats['Datetime'] = start_time
+
+    for hour in reached:
+        files = interval_files(run_directory, hour, output_location)
+        seq_data[hour]['files'] = {'fastq': files['fastq'], 'stats': files['stats'], 'summary': files['summary']}
+
+    metrics = MetricsRecorder(full_run_name)
+    summary_file = list(Path(run_directory).rglob('*sequencing_summary.txt'))[0]
+    summary_outputs = [open(seq_data[hour]['files']['summary'], 'w') for hour in reached]
+    try:
+        with metrics.span('summary_scan'):
+            intervals, routes = find_reads_at_times(
+                summary_file, [hour_to_seconds(h) for h in reached], summary_outputs)
+    finally:
+        for summary_output in summary_outputs:
+            summary_output.close()
+
+    fastq_files = [open(seq_data[hour]['files']['fastq'], 'wb') for hour in reached]
+    fastq_outputs = [HashingWriter(fastq_file) for fastq_file in fastq_files]
+    try:
+        with metrics.span('fastq_extraction'):
+            if routes:
+                all_fastqs = list(Path(run_directory).rglob('*.fastq'))
+                if index_directory:
+                    index_file = os.path.join(index_directory, '%s.read_index.sqlite' % full_run_name)
+                    with ReadIndex(index_file) as read_index:
+                        read_index.update(all_fastqs, processes=processes)
+                        extracted = read_index.route(all_fastqs, routes, fastq_outputs)
+                else:
+                    extracted = route_fastq_records(
+                        all_fastqs, routes, fastq_outputs, processes=processes, shard_directory=output_location)
+            else:
+                extracted = {'records': [0] * len(reached), 'bases': [0] * len(reached), 'found': set()}
+    finally:
+        for fastq_file in fastq_files:
+            fastq_file.close()
+
+    with metrics.span('md5_and_stats'):
+        for ix, hour in enumerate(reached):
+            interval = intervals[ix]
+            seq_data[hour]['total_reads'] = interval['total_reads']
+
+            missing_reads = [r for r, first in routes.items() if first <= ix and r not in extracted['found']]
+            if missing_reads:
+                seq_data[hour]['missing_reads'] = missing_reads
+
+            stats = dict(run_stats)
+            stats['Total reads'] = interval['total_reads']
+            stats['Analysed reads'] = interval['passed_reads']
+            stats['Mean read length'] = calculate_mean_read_length(
+                {'records': extracted['records'][ix], 'bases': extracted['bases'][ix]})
+            stats['Mean Q-score'] = interval['mean_qscore']
+            stats['MD5'] = fastq_outputs[ix].hexdigest()
+            write_cached_hash(seq_data[hour]['files']['fastq'], stats['MD5'])
+            stats['Hour'] = hour
+
+            with open(seq_data[hour]['files']['stats'], 'w') as stats_output:
+                for k, v in stats.items():
+                    stats_output.write('{metric}\t{score}\n'.format(metric=k, score=v))
+
+    # the summary and FASTQ files were read once for all intervals, so each interval gets the same spans
+    for hour in reached:
+        metrics_filepath = interval_files(run_directory, hour, output_location)['metrics']
+        metrics.write(metrics_filepath)
+        seq_data[hour]['files']['metrics'] = metrics_filepath
 
     return seq_data
 
 
+def process_run_at_time(run_directory, recorded_stats, hour, output_location, processes=1, index_directory=None):
+    seq_data = process_run_at_intervals(
+        run_directory, recorded_stats, [hour], output_location, processes=processes, index_directory=index_directory)
+    return seq_data[hour]
+
+
 def argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--directory', action='store', required=True)
     parser.add_argument('--recorded_stats', action='store', required=True)
-    parser.add_argument('--hour', action='store', required=True)
+    parser.add_argument('--hour', action='store', required=True, nargs='+')  # one or more intervals
     parser.add_argument('--output_location', action='store', required=True)
+    parser.add_argument('--processes', action='store', default=1)
+    parser.add_argument('--index_directory', action='store')  # directory for the persistent read index
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = argument_parser()
-    process_run_at_time(
+    process_run_at_intervals(
         run_directory=args.directory,
         recorded_stats=args.recorded_stats,
-        hour=int(args.hour),
-        output_location=args.output_location
+        hours=[int(h) for h in args.hour],
+        output_location=args.output_location,
+        processes=int(args.processes),
+        index_directory=args.index_directory
     )
@@ -0,0 +1,164 @@
+import multiprocessing
+import os
+import sqlite3
+from fastq_extraction import read_fastq_records
+
+
+def _scan_fastq(path):
+    """Returns (read_id, offset, record length, sequence length) for each record in a FASTQ file."""
+    with open(path, 'rb') as infile:
+        return [(read_id.decode(), offset, len(record), seq_len)
+                for read_id, offset, record, seq_len in read_fastq_records(infile)]
+
+
+class ReadIndex(object):
+    """Persistent index of where each read of a sequencing run is stored in its FASTQ files.
+
+    The index is a SQLite database mapping read_id to (fastq file, byte offset, record length). FASTQ files are only
+    re-scanned when their size or modification time changes, so extracting reads at a later interval only costs the
+    time to index the files written since the previous interval.
+
+    Args:
+        index_file (str): path to the SQLite database, created if it does not exist.
+
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.conn = sqlite3.connect(index_file)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                file_id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime REAL
+            );
+            CREATE TABLE IF NOT EXISTS reads (
+                read_id TEXT, file_id INTEGER, offset INTEGER, length INTEGER, seq_len INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS reads_by_file ON reads (file_id, offset);
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, fastq_list, processes=1):
+        """Brings the index up to date with the given FASTQ files.
+
+        New files are indexed, files whose size or mtime has changed are re-indexed and files that are no longer
+        present are dropped. With processes > 1 the files are parsed in a process pool, while the index is written
+        from this process only.
+
+        Args:
+            fastq_list (list): paths to all FASTQ files in the run
+            processes (int): number of processes used to parse the files to (re)index
+
+        Returns:
+            updated (int): number of files (re)indexed
+        """
+        indexed = {path: (file_id, size, mtime) for file_id, path, size, mtime in
+                   self.conn.execute('SELECT file_id, path, size, mtime FROM files')}
+        current = set()
+        changed = list()
+        for fastq in fastq_list:
+            path = os.path.abspath(str(fastq))
+            current.add(path)
+            stat = os.stat(path)
+            if path in indexed and indexed[path][1:] == (stat.st_size, stat.st_mtime):
+                continue
+            changed.append((path, stat))
+
+        paths = [path for path, stat in changed]
+        if processes > 1 and len(paths) > 1:
+            pool = multiprocessing.Pool(min(processes, len(paths)))
+            try:
+                self._write_scans(changed, pool.imap(_scan_fastq, paths), indexed)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            self._write_scans(changed, (_scan_fastq(path) for path in paths), indexed)
+
+        with self.conn:
+            for path in set(indexed) - current:
+                file_id = indexed[path][0]
+                self.conn.execute('DELETE FROM reads WHERE file_id = ?', (file_id,))
+                self.conn.execute('DELETE FROM files WHERE file_id = ?', (file_id,))
+
+        return len(changed)
+
+    def _write_scans(self, changed, scans, indexed):
+        for (path, stat), records in zip(changed, scans):
+            with self.conn:
+                if path in indexed:
+                    file_id = indexed[path][0]
+                    self.conn.execute('DELETE FROM reads WHERE file_id = ?', (file_id,))
+                    self.conn.execute('UPDATE files SET size = ?, mtime = ? WHERE file_id = ?',
+                                      (stat.st_size, stat.st_mtime, file_id))
+                else:
+                    file_id = self.conn.execute('INSERT INTO files (path, size, mtime) VALUES (?, ?, ?)',
+                                                (path, stat.st_size, stat.st_mtime)).lastrowid
+                self.conn.executemany('INSERT INTO reads VALUES (?, ?, ?, ?, ?)',
+                                      ((read_id, file_id, offset, length, seq_len)
+                                       for read_id, offset, length, seq_len in records))
+
+    def route(self, fastq_list, routes, outputs):
+        """Copies the records for the given reads into one or more outputs by seeking directly to them.
+
+        Records are routed as in route_fastq_records, and written in the same order: by position in fastq_list, then
+        by position within each file. The index must have been updated with fastq_list first.
+
+        Args:
+            fastq_list (list): paths to FASTQ files to search
+            routes (dict): read ID to index of the first output the read should be written to
+            outputs (list): binary file handles to write matching records to
+
+        Returns:
+            extracted (dict): {'records': [records per output], 'bases': [sequence length per output],
+                               'found': set of read IDs found}
+        """
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (read_id TEXT PRIMARY KEY, first INTEGER)')
+        self.conn.execute('DELETE FROM wanted')
+        self.conn.executemany('INSERT OR IGNORE INTO wanted VALUES (?, ?)', routes.items())
+
+        n_outputs = len(outputs)
+        records = [0] * n_outputs
+        bases = [0] * n_outputs
+        found = set()
+        for fastq in fastq_list:
+            path = os.path.abspath(str(fastq))
+            rows = self.conn.execute(
+                'SELECT r.read_id, w.first, r.offset, r.length, r.seq_len FROM reads r '
+                'JOIN files f ON r.file_id = f.file_id JOIN wanted w ON r.read_id = w.read_id '
+                'WHERE f.path = ? ORDER BY r.offset', (path,))
+            with open(path, 'rb') as infile:
+                for read_id, first, offset, length, seq_len in rows:
+                    infile.seek(offset)
+                    record = infile.read(length)
+                    if not record.endswith(b'\n'):
+                        record += b'\n'
+                    found.add(read_id)
+                    for ix in range(first, n_outputs):
+                        outputs[ix].write(record)
+                        records[ix] += 1
+                        bases[ix] += seq_len
+
+        self.conn.execute('DELETE FROM wanted')
+        return {'records': records, 'bases': bases, 'found': found}
+
+    def extract(self, fastq_list, read_ids, output):
+        """Copies the records for the given reads into output, see route.
+
+        Args:
+            fastq_list (list): paths to FASTQ files to search
+            read_ids (iterable): read IDs to extract
+            output (file): binary file handle to write matching records to
+
+        Returns:
+            extracted (dict): {'records': number written, 'bases': total sequence length, 'found': set of read IDs}
+        """
+        extracted = self.route(fastq_list, dict.fromkeys(read_ids, 0), [output])
+        return {'records': extracted['records'][0], 'bases': extracted['bases'][0], 'found': extracted['found']}
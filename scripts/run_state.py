@@ -0,0 +1,126 @@
+import argparse
+from datetime import datetime
+import os
+import re
+import sqlite3
+
+# intervals with these statuses need nothing more; 'extracted' ones still have to be copied to the workstation
+DONE_STATUSES = ('copied', 'processed', 'legacy')
+
+
+class RunState(object):
+    """Persistent record of which time intervals of each sequencing run have been processed.
+
+    State is kept in a SQLite database rather than as marker files in the run directories, so checking what is due
+    costs one query per run instead of a walk over the run's fast5 and fastq trees. A run seen for the first time is
+    seeded from any marker files left by earlier versions of the automation ('<hour>hr_started', analysis_complete*),
+    which needs one walk of that run's directory.
+
+    Args:
+        state_file (str): path to the SQLite database, created if it does not exist.
+
+    """
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.conn = sqlite3.connect(state_file)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS runs (
+                run TEXT PRIMARY KEY, first_seen TEXT, completed TEXT
+            );
+            CREATE TABLE IF NOT EXISTS intervals (
+                run TEXT, hour INTEGER, status TEXT, updated TEXT, total_reads INTEGER, PRIMARY KEY (run, hour)
+            );
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _now():
+        return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def _import_legacy_markers(self, run_directory, intervals):
+        """Records intervals and completion from marker files written into the run directory by older versions."""
+        run = os.path.basename(os.path.normpath(run_directory))
+        completed = None
+        started = set()
+        interval_regex = {hour: re.compile(r'(?<!\d)%shr' % hour) for hour in intervals}
+        for root, dirs, files in os.walk(run_directory):
+            for name in files + dirs:
+                if name.startswith('analysis_complete'):
+                    completed = self._now()
+                for hour, regex in interval_regex.items():
+                    if regex.search(name):
+                        started.add(hour)
+        with self.conn:
+            self.conn.execute('INSERT INTO runs VALUES (?, ?, ?)', (run, self._now(), completed))
+            self.conn.executemany('INSERT OR IGNORE INTO intervals VALUES (?, ?, ?, ?, NULL)',
+                                  [(run, hour, 'legacy', self._now()) for hour in started])
+
+    def due_intervals(self, run_directory, intervals):
+        """Returns the intervals of a run that have not been processed and copied, or [] if the run is complete.
+
+        Args:
+            run_directory (str): sequencing run output directory
+            intervals (list): all time intervals in hours
+
+        Returns:
+            due (list): intervals not yet processed, in the order given
+        """
+        run = os.path.basename(os.path.normpath(run_directory))
+        row = self.conn.execute('SELECT completed FROM runs WHERE run = ?', (run,)).fetchone()
+        if row is None:
+            self._import_legacy_markers(run_directory, intervals)
+            row = self.conn.execute('SELECT completed FROM runs WHERE run = ?', (run,)).fetchone()
+        if row[0]:
+            return []
+        done = set(h for h, status in self.conn.execute('SELECT hour, status FROM intervals WHERE run = ?', (run,))
+                   if status in DONE_STATUSES)
+        return [hour for hour in intervals if hour not in done]
+
+    def extracted_intervals(self, run_directory):
+        """Returns {hour: total reads} for intervals whose files were written but not copied, so they can be resent."""
+        run = os.path.basename(os.path.normpath(run_directory))
+        return dict(self.conn.execute(
+            'SELECT hour, total_reads FROM intervals WHERE run = ? AND status = ?', (run, 'extracted')).fetchall())
+
+    def mark_interval(self, run_directory, hour, status, total_reads=None):
+        """Records an interval's progress e.g. 'extracted' once its files are written, 'copied' once sent on."""
+        run = os.path.basename(os.path.normpath(run_directory))
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO intervals VALUES (?, ?, ?, ?, ?)',
+                              (run, hour, status, self._now(), total_reads))
+
+    def mark_complete(self, run_directory):
+        run = os.path.basename(os.path.normpath(run_directory))
+        with self.conn:
+            self.conn.execute('UPDATE runs SET completed = ? WHERE run = ?', (self._now(), run))
+
+    def summary(self):
+        """Yields (run, completed, [(hour, status, total_reads)]) for every run, oldest first."""
+        for run, completed in self.conn.execute('SELECT run, completed FROM runs ORDER BY first_seen, run').fetchall():
+            intervals = self.conn.execute(
+                'SELECT hour, status, total_reads FROM intervals WHERE run = ? ORDER BY hour', (run,)).fetchall()
+            yield run, completed, intervals
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Shows the processing state of sequencing runs.')
+    parser.add_argument('--state_file', action='store', required=True)  # path to run state database
+    return parser
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_args()
+    with RunState(args.state_file) as run_state:
+        for run_name, run_completed, run_intervals in run_state.summary():
+            print('{run}\t{completed}\t{intervals}'.format(
+                run=run_name, completed=run_completed or '-',
+                intervals=', '.join('%shr:%s' % (h, s) for h, s, r in run_intervals)))
@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+import os
+import threading
+
+
+def io_pressure():
+    """Returns the share of the last 10 seconds (%) in which some task was stalled on I/O, or None if unavailable.
+
+    Read from the kernel's pressure stall information, /proc/pressure/io (Linux 4.20+).
+    """
+    try:
+        with open('/proc/pressure/io') as infile:
+            for line in infile:
+                if line.startswith('some'):
+                    fields = dict(f.split('=') for f in line.split()[1:])
+                    return float(fields['avg10'])
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+class RunLogger(logging.LoggerAdapter):
+    """Logger adapter that adds a run's name, and the interval being processed, to each record.
+
+    Replaces passing extra={'run': ..., 'time': ...} to every call, so concurrent runs log with their own context.
+    """
+
+    def __init__(self, logger, run, time_text=''):
+        super(RunLogger, self).__init__(logger, {'run': run, 'time': time_text})
+
+    def process(self, msg, kwargs):
+        extra = dict(self.extra)
+        extra.update(kwargs.get('extra', {}))
+        kwargs['extra'] = extra
+        return msg, kwargs
+
+    def for_interval(self, hour):
+        return RunLogger(self.logger, self.extra['run'], '%shr' % hour)
+
+
+class RunScheduler(object):
+    """Runs jobs for independent sequencing runs concurrently.
+
+    Jobs run in a thread pool; the heavy work they do (FASTQ extraction process pools, scp) happens outside the
+    interpreter lock. A new job is only started while the system load average and I/O pressure are below their limits,
+    except that one job is always allowed to run so a busy machine cannot stall processing altogether. Transfers are
+    limited separately through transfer_slots, which jobs should hold while copying. As the runs share one process,
+    metrics recorded while runs overlap cover the whole process and are marked process_wide, see metrics.Span.
+
+    Args:
+        max_runs (int): maximum number of runs processed at once
+        max_transfers (int): maximum number of transfers at once
+        max_load (float): 1 minute load average above which no further runs are started
+        max_io_pressure (float): I/O pressure (%) above which no further runs are started
+        poll_interval (float): seconds between checks while throttled
+
+    Yields:
+        transfer_slots (threading.BoundedSemaphore): semaphore jobs hold while transferring files
+    """
+
+    def __init__(self, max_runs=2, max_transfers=1, max_load=None, max_io_pressure=None, poll_interval=10):
+        self.max_runs = max(1, max_runs)
+        self.max_load = max_load
+        self.max_io_pressure = max_io_pressure
+        self.poll_interval = poll_interval
+        self.transfer_slots = threading.BoundedSemaphore(max(1, max_transfers))
+
+    def busy(self):
+        """Returns True if the system is too loaded to start another run."""
+        if self.max_load is not None and os.getloadavg()[0] > self.max_load:
+            return True
+        if self.max_io_pressure is not None:
+            pressure = io_pressure()
+            if pressure is not None and pressure > self.max_io_pressure:
+                return True
+        return False
+
+    def run(self, job, tasks):
+        """Calls job(*task) for each task, yielding (task, result, exception) as each finishes.
+
+        Results are yielded in the calling thread, so callers can record them without locking.
+        """
+        pending = list(tasks)
+        running = dict()
+        with ThreadPoolExecutor(max_workers=self.max_runs) as executor:
+            while pending or running:
+                while pending and len(running) < self.max_runs and (not running or not self.busy()):
+                    task = pending.pop(0)
+                    running[executor.submit(job, *task)] = task
+                done, not_done = wait(list(running), timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    yield task, future.result() if not future.exception() else None, future.exception()
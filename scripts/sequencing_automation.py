@@ -1,3 +1,4 @@
+import argparse
 import config
 from datetime import datetime
 import logging
@@ -5,130 +6,259 @@ import os
 from pathlib import Path
 import shutil
 import sys
+import time
 # sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
-from data_transfer import copy_to_remote_location, compress_directory, upload_to_dnanexus, get_basecaller_version
-from process_sequencing_run import process_run_at_time
+from data_transfer import (copy_to_remote_location, compress_directory, upload_to_dnanexus, get_basecaller_version,
+                           write_manifest, MANIFEST_SUFFIX)
+from job_queue import try_lock
+from process_sequencing_run import process_run_at_intervals, find_run_start_time, hour_to_seconds, interval_files
+from run_state import RunState, DONE_STATUSES
+from scheduler import RunLogger, RunScheduler
+from watcher import run_daemon
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--daemon', action='store_true')  # keep running and process runs as they become due
+    return parser.parse_args()
 
 
 def create_log_file(filename):
+    """Attaches a handler for filename to main_logger, replacing any handler for a previous day's file."""
+    logger = logging.getLogger('main_logger')
+    for existing in list(logger.handlers):
+        if isinstance(existing, logging.FileHandler):
+            if existing.baseFilename == os.path.abspath(filename):
+                return logger
+            logger.removeHandler(existing)
+            existing.close()
+
     formatter = logging.Formatter(
         '%(levelname)s\t%(asctime)s\t%(run)s\t%(time)s\t%(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )
     handler = logging.FileHandler(filename)
     handler.setFormatter(formatter)
-    logger = logging.getLogger('main_logger')
     logger.setLevel(logging.DEBUG)
     logger.addHandler(handler)
     return logger
 
 
-def main():
+def main(daemon=False):
+    if daemon:
+        run_daemon(process_due_runs, [config.Gridion.sequencing_output], config.Gridion.heartbeat,
+                   config.Gridion.daemon_interval)
+    else:
+        process_due_runs()
+
+
+def process_due_runs():
+    """Processes every run with due intervals, unless another pass is already doing so.
+
+    Returns:
+        next_due (float): seconds until the next interval of a run already seen becomes due, None if there is none or
+                          another pass holds the lock
+    """
     log_filename = os.path.join(config.Gridion.log_files, 'Pipeline-%s.log' % datetime.now().strftime('%Y%m%d'))
     main_logger = create_log_file(log_filename)
 
     if not os.path.exists(config.Gridion.processed_files):
         os.mkdir(config.Gridion.processed_files)
 
+    if not os.path.exists(config.Gridion.read_indexes):
+        os.mkdir(config.Gridion.read_indexes)
+
+    # cron starts a pass every minute, and may overlap the daemon, so only one pass works on the runs at a time
+    lock_fd = try_lock(config.Gridion.run_state + '.lock')
+    if lock_fd is None:
+        main_logger.info('Another pass is still processing runs.', extra={'run': '', 'time': ''})
+        return None
+    try:
+        return _process_due_runs(main_logger)
+    finally:
+        os.close(lock_fd)
+
+
+def _process_due_runs(main_logger):
     os.chdir(config.Gridion.sequencing_output)
     run_dirs = [d for d in os.listdir('.') if os.path.isdir(d) and d.startswith('16S_')]
 
-    for run_dir in run_dirs:
+    with RunState(config.Gridion.run_state) as run_state:
+        tasks = list()
+        scheduler = RunScheduler(
+            max_runs=config.Gridion.concurrent_runs,
+            max_transfers=config.Gridion.concurrent_transfers,
+            max_load=config.Gridion.max_load,
+            max_io_pressure=config.Gridion.max_io_pressure
+        )
+        for run_dir in run_dirs:
+            due_intervals = run_state.due_intervals(run_dir, config.time_intervals)
+            if due_intervals:
+                tasks.append((run_dir, due_intervals, RunLogger(main_logger, run_dir), scheduler.transfer_slots,
+                              run_state.extracted_intervals(run_dir)))
+
+        # runs are processed concurrently, state is only updated here in the main thread
+        due_times = list()
+        for task, processed, error in scheduler.run(process_run, tasks):
+            run_dir, due_intervals, run_logger = task[:3]
+            if error:
+                run_logger.error('Processing failed.', exc_info=error)
+                continue
+            for interval, (status, total_reads) in processed.items():
+                run_state.mark_interval(run_dir, interval, status, total_reads=total_reads)
+            # complete once the last interval, and any earlier one whose copy failed, has been copied
+            last_status = processed.get(config.time_intervals[-1], (None, None))[0]
+            if last_status in DONE_STATUSES and not run_state.due_intervals(run_dir, config.time_intervals):
+                run_state.mark_complete(run_dir)
+            remaining = [i for i in due_intervals if i not in processed]
+            if remaining:
+                start_time = float(find_run_start_time(run_dir))
+                due_times.append(start_time + hour_to_seconds(min(remaining)))
+
+    return max(0, min(due_times) - time.time()) if due_times else None
+
+
+def process_run(run_dir, due_intervals, run_logger, transfer_slots, extracted=None):
+    """Processes the due intervals of a run and copies the files for each to the workstation.
 
-        if list(Path(run_dir).rglob('analysis_complete*')):
+    Args:
+        run_dir (str): sequencing run directory
+        due_intervals (list): intervals in hours that have not been copied yet
+        run_logger (RunLogger): logger for this run
+        transfer_slots (threading.BoundedSemaphore): held while copying files
+        extracted (dict): hour to total reads for due intervals whose files were written by an earlier pass, which
+                          are copied again without being extracted again
+
+    Returns:
+        processed (dict): interval to (status, total reads) for each interval processed
+    """
+    processed = dict()
+    extracted = extracted or dict()
+    run_logger.info('Processing sequencing files.', extra={'time': ','.join('%shr' % i for i in due_intervals)})
+
+    seq_data_per_interval = dict()
+    to_extract = list()
+    for interval in due_intervals:
+        files = interval_files(run_dir, interval, config.Gridion.processed_files)
+        if interval in extracted and all(os.path.exists(f) for f in files.values()):
+            seq_data_per_interval[interval] = {'files': files, 'total_reads': extracted[interval], 'resend': True}
+        else:
+            to_extract.append(interval)
+
+    if to_extract:
+        seq_data_per_interval.update(process_run_at_intervals(
+            run_directory=run_dir,
+            recorded_stats=config.Gridion.run_stats,
+            hours=to_extract,
+            output_location=config.Gridion.processed_files,
+            processes=config.Gridion.extraction_processes,
+            index_directory=config.Gridion.read_indexes
+        ))
+
+    for interval in due_intervals:
+
+        seq_data = seq_data_per_interval[interval]
+        if not seq_data:
             continue
+
+        elif seq_data.get('resend'):
+            processed[interval] = ('extracted', seq_data['total_reads'])
+            interval_logger = run_logger.for_interval(interval)
+            interval_logger.info('Copying files extracted by an earlier pass again.')
+
         else:
+            processed[interval] = ('extracted', seq_data['total_reads'])
+
+            interval_logger = run_logger.for_interval(interval)
+
+            interval_logger.info('%s passed reads found.' % seq_data['total_reads'])
+            missing_reads = seq_data.get('missing_reads')
+            if missing_reads:
+                interval_logger.warning(
+                    'The following %s reads were not found %s.' % (len(missing_reads), ', '.join(missing_reads))
+                )
+
+            interval_logger.info('Processing completed.')
 
-            for interval in config.time_intervals:
-
-                if list(Path(run_dir).rglob('*%shr*' % interval)):
-                    continue
-
-                else:
-
-                    logging_args = {'run': run_dir, 'time': '%shr' % interval}
-
-                    main_logger.info('Processing sequencing files.', extra=logging_args)
-
-                    seq_data = process_run_at_time(
-                        run_directory=run_dir,
-                        recorded_stats=config.Gridion.run_stats,
-                        hour=interval,
-                        output_location=config.Gridion.processed_files
-                    )
-
-                    main_logger.info('%s passed reads found.' % seq_data['total_reads'], extra=logging_args)
-                    missing_reads = seq_data.get('missing_reads')
-                    if missing_reads:
-                        main_logger.warning(
-                            'The following %s reads were not found %s.' % (len(missing_reads), ', '.join(missing_reads)),
-                            extra=logging_args
-                        )
-
-                    main_logger.info('Processing completed.', extra=logging_args)
-
-                    if config.setting == 'local':
-                        copy_to_remote_location(
-                            files=seq_data['files'].values(),
-                            username=config.Workstation.username,
-                            ip_address=config.Workstation.ip_address,
-                            path=config.Workstation.pipeline_input,
-                            ssh_password_file=config.Gridion.sshpass_file  # make sure to change this locally !!
-                        )
-                        main_logger.info(
-                            'Pipeline files copied to %s in remote location.' % config.Workstation.pipeline_input,
-                            extra=logging_args
-                        )
-                    else:
-                        # TODO: run pipeline in dnanexus
-                        pass
-                    '''
-                    if interval == config.time_intervals[-1]:
+        if config.setting == 'local':
+            # the workstation starts the pipeline as soon as the manifest arrives, which is renamed into place last
+            manifest = seq_data['files']['fastq'].replace('.fastq', MANIFEST_SUFFIX)
+            write_manifest(manifest, seq_data['files'].values())
+            with transfer_slots:
+                copied = copy_to_remote_location(
+                    files=seq_data['files'].values(),
+                    username=config.Workstation.username,
+                    ip_address=config.Workstation.ip_address,
+                    path=config.Workstation.pipeline_input,
+                    ssh_password_file=config.Gridion.sshpass_file,  # make sure to change this locally !!
+                    manifest=manifest,
+                    streams=config.transfer_streams
+                )
+            if copied:
+                processed[interval] = ('copied', seq_data['total_reads'])
+                interval_logger.info(
+                    'Pipeline files copied to %s in remote location (%.1f MB in %.1fs, %.1f MB/s).' % (
+                        config.Workstation.pipeline_input, copied['bytes_sent'] / 1048576.0, copied['seconds'],
+                        copied['mb_per_second'])
+                )
+            else:
+                interval_logger.error(
+                    'Copying pipeline files to %s in remote location failed.' % config.Workstation.pipeline_input
+                )
+        else:
+            # TODO: run pipeline in dnanexus
+            processed[interval] = ('processed', seq_data['total_reads'])
+
+            '''
+            if interval == config.time_intervals[-1]:
     
-                        # write file to indicate analysis is completed.
-                        completion_file = os.path.join(
-                            run_dir, 'analysis_complete_%s' % datetime.now().strftime('%Y%m%d-%H%M%S'))
-                        Path(completion_file).touch()
+                # write file to indicate analysis is completed.
+                completion_file = os.path.join(
+                    run_dir, 'analysis_complete_%s' % datetime.now().strftime('%Y%m%d-%H%M%S'))
+                Path(completion_file).touch()
     
-                        # upload files to dnanexus
-                        def upload(file_for_upload, location):
-                            upload_log = upload_to_dnanexus(file_for_upload, location, config.Dnanexus.ua,
-                                                            config.Dnanexus.project, config.Dnanexus.api_token)
-                            main_logger.info(upload_log, extra=logging_args)
+                # upload files to dnanexus
+                def upload(file_for_upload, location):
+                    upload_log = upload_to_dnanexus(file_for_upload, location, config.Dnanexus.ua,
+                                                    config.Dnanexus.project, config.Dnanexus.api_token)
+                    interval_logger.info(upload_log)
     
-                        # upload fast5 files
-                        dnanexus_run_loc = os.path.join(config.Dnanexus.base_folder, run_dir)
-                        fast5_folders = list(Path(run_dir).rglob('fast5_*'))
-                        for fast5 in fast5_folders:
-                            compressed_fast5 = compress_directory(str(fast5))
-                            upload(compressed_fast5, dnanexus_run_loc)
+                # upload fast5 files
+                dnanexus_run_loc = os.path.join(config.Dnanexus.base_folder, run_dir)
+                fast5_folders = list(Path(run_dir).rglob('fast5_*'))
+                for fast5 in fast5_folders:
+                    compressed_fast5 = compress_directory(str(fast5))
+                    upload(compressed_fast5, dnanexus_run_loc)
     
-                        # get basecaller version for folder name
-                        basecaller = get_basecaller_version()
-                        basecaller_loc = os.path.join(dnanexus_run_loc, basecaller)
+                # get basecaller version for folder name
+                basecaller = get_basecaller_version()
+                basecaller_loc = os.path.join(dnanexus_run_loc, basecaller)
     
-                        # upload fastq files
-                        fastq_folders = [f for f in list(Path(run_dir).rglob('fastq_*')) if os.path.isdir(str(f))]
-                        for fastq in fastq_folders:
-                            compressed_fastq = compress_directory(fastq)
-                            upload(compressed_fastq, basecaller_loc)
+                # upload fastq files
+                fastq_folders = [f for f in list(Path(run_dir).rglob('fastq_*')) if os.path.isdir(str(f))]
+                for fastq in fastq_folders:
+                    compressed_fastq = compress_directory(fastq)
+                    upload(compressed_fastq, basecaller_loc)
     
-                        # upload sequencing log files
-                        log_files = list(Path(run_dir).rglob('*.log'))
-                        if log_files:
-                            path_list = str(log_files[0]).split('/')[-1]
-                            seq_logs = '{path}/log_files'.format(path='/'.join(path_list))
-                            os.mkdir(seq_logs)
-                            for f in log_files:
-                                shutil.move(str(f), seq_logs)
-                            compressed_logs = compress_directory(seq_logs)
-                            upload(compressed_logs, basecaller_loc)
+                # upload sequencing log files
+                log_files = list(Path(run_dir).rglob('*.log'))
+                if log_files:
+                    path_list = str(log_files[0]).split('/')[-1]
+                    seq_logs = '{path}/log_files'.format(path='/'.join(path_list))
+                    os.mkdir(seq_logs)
+                    for f in log_files:
+                        shutil.move(str(f), seq_logs)
+                    compressed_logs = compress_directory(seq_logs)
+                    upload(compressed_logs, basecaller_loc)
     
-                        # upload other files
-                        for f in list(Path(run_dir).rglob('sequencing_*')):
-                            upload(str(f), basecaller_loc)
-                    '''
+                # upload other files
+                for f in list(Path(run_dir).rglob('sequencing_*')):
+                    upload(str(f), basecaller_loc)
+            '''
+
+    return processed
 
 
 if __name__ == '__main__':
-    main()
+    args = argument_parser()
+    main(daemon=args.daemon)
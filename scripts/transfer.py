@@ -0,0 +1,437 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import posixpath
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from data_transfer import hash_file, read_cached_hash
+
+CHUNK_SIZE = 64 * 1024 * 1024  # files are sent in chunks of this size, several at once
+COPY_BUFFER_SIZE = 1024 * 1024
+STAGING_PREFIX = '.incoming-'
+
+
+class LocalBackend(object):
+    """Transfer backend for destinations on a local or mounted filesystem, also used for testing."""
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def makedirs(self, paths):
+        for path in paths:
+            os.makedirs(path, exist_ok=True)
+
+    def prepare(self, files):
+        """Creates each (path, size) file if it does not exist and sets its size, keeping any data already sent."""
+        for path, size in files:
+            with open(path, 'ab') as outfile:
+                outfile.truncate(size)
+
+    def write_chunk(self, local_path, offset, length, path):
+        with open(local_path, 'rb') as infile, open(path, 'r+b') as outfile:
+            infile.seek(offset)
+            outfile.seek(offset)
+            while length > 0:
+                data = infile.read(min(COPY_BUFFER_SIZE, length))
+                if not data:
+                    raise RuntimeError('%s is shorter than expected' % local_path)
+                outfile.write(data)
+                length -= len(data)
+
+    def existing(self, paths):
+        return [p for p in paths if os.path.lexists(p)]
+
+    def md5(self, path):
+        return hash_file(path, use_cache=False)
+
+    def commit(self, renames, staging):
+        """Moves each (staged path, destination path) into place in order, replacing existing files or directories.
+
+        Renames already made by an earlier, interrupted commit (staged path gone, destination present) are skipped.
+        """
+        for staged, destination in renames:
+            if not os.path.lexists(staged) and os.path.lexists(destination):
+                continue
+            if os.path.isdir(destination) and not os.path.islink(destination):
+                shutil.rmtree(destination)
+            os.replace(staged, destination)
+        if os.path.isdir(staging):
+            os.rmdir(staging)
+
+
+class SSHBackend(object):
+    """Transfer backend for destinations on another host, reached with ssh.
+
+    Between connect and close, all commands share one connection through an OpenSSH control master, so each costs a
+    new channel rather than a new handshake and login. Chunks are written in place on the remote host with dd, so
+    several can be sent at once and a partly sent file can be resumed.
+
+    Args:
+        username (str): remote user
+        host (str): remote host name or IP address
+        password_file (str): file holding the password, for sshpass; None to use keys
+        connect_timeout (int): seconds to wait for the connection
+    """
+
+    def __init__(self, username, host, password_file=None, connect_timeout=30):
+        self.username = username
+        self.host = host
+        self.password_file = password_file
+        self.connect_timeout = connect_timeout
+        self.control_path = None
+
+    def _ssh(self, options):
+        command = ['sshpass', '-f', self.password_file] if self.password_file else []
+        command += ['ssh', '-o', 'ConnectTimeout=%s' % self.connect_timeout]
+        if self.control_path:
+            command += ['-o', 'ControlPath=%s' % self.control_path]
+        return command + options + ['%s@%s' % (self.username, self.host)]
+
+    def run(self, remote_command):
+        """Runs a shell command on the remote host and returns its output, raising RuntimeError if it fails."""
+        process = subprocess.Popen(self._ssh([]) + [remote_command], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError('%s on %s failed: %s' % (remote_command, self.host, stderr.decode(errors='replace')))
+        return stdout.decode()
+
+    def connect(self):
+        """Starts the control master connection that later commands share."""
+        control_directory = tempfile.mkdtemp(prefix='ssh-')  # socket paths are limited to about 100 characters
+        self.control_path = os.path.join(control_directory, 'control')
+        # output goes to /dev/null, as the backgrounded master would otherwise hold the pipes open
+        if subprocess.call(self._ssh(['-o', 'ControlMaster=yes', '-f', '-N']), stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL) != 0:
+            self.close()
+            raise RuntimeError('Could not connect to %s.' % self.host)
+
+    def close(self):
+        if self.control_path:
+            subprocess.call(self._ssh(['-O', 'exit']), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            shutil.rmtree(os.path.dirname(self.control_path), ignore_errors=True)
+            self.control_path = None
+
+    def makedirs(self, paths):
+        self.run('mkdir -p %s' % ' '.join(shlex.quote(p) for p in paths))
+
+    def prepare(self, files):
+        self.run(' && '.join('touch {p} && truncate -s {size} {p}'.format(p=shlex.quote(path), size=size)
+                             for path, size in files) or 'true')
+
+    def write_chunk(self, local_path, offset, length, path):
+        dd = 'dd of=%s bs=1M seek=%s oflag=seek_bytes conv=notrunc 2>/dev/null' % (shlex.quote(path), offset)
+        process = subprocess.Popen(self._ssh([]) + [dd], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            with open(local_path, 'rb') as infile:
+                infile.seek(offset)
+                while length > 0:
+                    data = infile.read(min(COPY_BUFFER_SIZE, length))
+                    if not data:
+                        raise RuntimeError('%s is shorter than expected' % local_path)
+                    process.stdin.write(data)
+                    length -= len(data)
+        except BrokenPipeError:
+            pass  # ssh has exited; its return code says why
+        except Exception:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        stderr = process.stderr.read()
+        if process.wait() != 0:
+            raise RuntimeError('Writing %s on %s failed: %s' % (path, self.host, stderr.decode(errors='replace')))
+
+    def existing(self, paths):
+        if not paths:
+            return []
+        output = self.run('for p in %s; do if [ -e "$p" ] || [ -L "$p" ]; then echo "$p"; fi; done' % ' '.join(
+            shlex.quote(p) for p in paths))
+        return output.splitlines()
+
+    def md5(self, path):
+        return self.run('md5sum %s' % shlex.quote(path)).split()[0]
+
+    def commit(self, renames, staging):
+        commands = list()
+        for staged, destination in renames:
+            # a rename made by an earlier, interrupted commit is skipped
+            commands.append('if [ -e {s} ] || [ -L {s} ]; then if [ -d {d} ] && [ ! -L {d} ]; then rm -rf {d}; fi && '
+                            'mv -f {s} {d}; elif [ ! -e {d} ]; then exit 1; fi'.format(s=shlex.quote(staged),
+                                                                                      d=shlex.quote(destination)))
+        commands.append('if [ -d {st} ]; then rmdir {st}; fi'.format(st=shlex.quote(staging)))
+        self.run(' && '.join(commands))
+
+
+class Journal(object):
+    """Record of the chunks of each file already sent, kept beside the local files so a transfer can be resumed.
+
+    Entries are dropped if the local file's size or mtime has changed since they were written.
+
+    Args:
+        filepath (str): journal file, created on the first save
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.entries = dict()
+        if os.path.exists(filepath):
+            with open(filepath) as infile:
+                self.entries = json.load(infile)
+
+    def entry(self, name, local_path):
+        stat = os.stat(local_path)
+        entry = self.entries.get(name)
+        if not entry or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'done': []}
+            self.entries[name] = entry
+        return entry
+
+    def mark_done(self, name, offset):
+        with self.lock:
+            self.entries[name]['done'].append(offset)
+            self.save()
+
+    def reset(self, name):
+        with self.lock:
+            self.entries[name]['done'] = []
+            self.save()
+
+    def save(self):
+        tmp_file = self.filepath + '.tmp'
+        with open(tmp_file, 'w') as outfile:
+            json.dump(self.entries, outfile)
+        os.replace(tmp_file, self.filepath)
+
+    def remove(self):
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+
+def transfer_id(files, destination):
+    """Returns a name for the transfer of these files to destination that is the same each time it is attempted."""
+    key = '\n'.join([destination] + sorted(os.path.abspath(str(f)) for f in files))
+    return hashlib.md5(key.encode()).hexdigest()[:16]
+
+
+def list_files(files):
+    """Returns (local path, path relative to the destination) for each file, expanding directories recursively."""
+    listed = list()
+    for f in files:
+        f = str(f)
+        name = os.path.basename(os.path.normpath(f))
+        if os.path.isdir(f):
+            for root, dirs, filenames in os.walk(f):
+                dirs.sort()
+                relative_root = os.path.relpath(root, f)
+                for filename in sorted(filenames):
+                    relative = posixpath.normpath(posixpath.join(name, relative_root.replace(os.sep, '/'), filename))
+                    listed.append((os.path.join(root, filename), relative))
+        else:
+            listed.append((f, name))
+    return listed
+
+
+class Transfer(object):
+    """Sends a set of files and directories to a destination directory as one batch.
+
+    Files are written into a hidden staging directory inside the destination, in chunks sent over several streams at
+    once, and each chunk is recorded in a journal as it completes. Once every file is written its MD5 hash is compared
+    on both sides, and files that differ are sent again. Only then are they renamed into place, the manifest (if any)
+    last, so nothing partial is ever visible at the destination. If the transfer fails it can be attempted again and
+    resumes from the journal, for staged files that still exist; items an interrupted commit already renamed into place
+    are checked by MD5 at the destination and not sent again. Staged files are always verified in the run that renames
+    them.
+
+    Args:
+        backend (LocalBackend or SSHBackend): how to reach the destination
+        files (list): local files and directories to send
+        destination (str): destination directory
+        manifest (str): local manifest file, renamed into place after everything else
+        streams (int): number of chunks sent at once
+        chunk_size (int): bytes per chunk
+        retries (int): times a failed step is retried before the transfer fails
+        journal_directory (str): where the resume journal is kept, defaults to the directory of the first file
+
+    Yields:
+        stats (dict): throughput metrics, filled in by run
+    """
+
+    def __init__(self, backend, files, destination, manifest=None, streams=4, chunk_size=CHUNK_SIZE, retries=3,
+                 journal_directory=None):
+        self.backend = backend
+        self.top_level = [str(f) for f in files] + ([manifest] if manifest else [])
+        self.files = list_files(self.top_level)
+        self.destination = destination
+        self.streams = max(1, streams)
+        self.chunk_size = chunk_size
+        self.retries = retries
+        identifier = transfer_id(self.top_level, destination)
+        self.staging = posixpath.join(destination, STAGING_PREFIX + identifier)
+        if journal_directory is None:
+            journal_directory = os.path.dirname(os.path.abspath(self.top_level[0]))
+        self.journal = Journal(os.path.join(journal_directory, '.transfer-%s.json' % identifier))
+        self.stats = {'files': len(self.files), 'bytes': 0, 'bytes_sent': 0, 'bytes_resumed': 0, 'retries': 0,
+                      'send_seconds': 0.0, 'verify_seconds': 0.0, 'seconds': 0.0, 'mb_per_second': 0.0}
+        self.stats_lock = threading.Lock()
+        self.remaining = list()  # top-level names still to be renamed into place
+
+    def _retry(self, function, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return function(*args)
+            except (IOError, OSError, RuntimeError) as e:
+                if attempt == self.retries:
+                    raise RuntimeError('Transfer to %s failed after %s attempts: %s' % (
+                        self.destination, attempt + 1, e))
+                with self.stats_lock:
+                    self.stats['retries'] += 1
+                time.sleep(min(30, 2 ** attempt))
+
+    def _send_chunk(self, chunk):
+        local_path, name, offset, length = chunk
+        self._retry(self.backend.write_chunk, local_path, offset, length, posixpath.join(self.staging, name))
+        self.journal.mark_done(name, offset)
+        with self.stats_lock:
+            self.stats['bytes_sent'] += length
+
+    def _matches(self, local_path, path):
+        local_md5 = read_cached_hash(local_path) or hash_file(local_path, use_cache=False)
+        return self._retry(self.backend.md5, path) == local_md5
+
+    def _verify(self, item):
+        local_path, name = item
+        if self._matches(local_path, posixpath.join(self.staging, name)):
+            return True
+        self.journal.reset(name)
+        return False
+
+    def _already_committed(self, top_name, files, existing):
+        """Returns True if an interrupted commit already renamed this item into place, checked by MD5."""
+        destination = posixpath.join(self.destination, top_name)
+        if destination not in existing or any(posixpath.join(self.staging, n) in existing for p, n in files):
+            return False
+        return all(self._matches(p, posixpath.join(self.destination, n)) for p, n in files)
+
+    def _pending_chunks(self):
+        chunks = list()
+        for local_path, name in self.files:
+            entry = self.journal.entry(name, local_path)
+            for offset in range(0, entry['size'], self.chunk_size):
+                if offset not in entry['done']:
+                    chunks.append((local_path, name, offset, min(self.chunk_size, entry['size'] - offset)))
+        return chunks
+
+    def run(self):
+        """Sends the files, raising RuntimeError if they cannot be sent and verified within the retries allowed.
+
+        Returns:
+            stats (dict): files, total bytes, bytes sent and resumed, retries, seconds sending, verifying and in total,
+                          and the sending rate in MB/s
+        """
+        started = time.time()
+        self._retry(self.backend.connect)
+        try:
+            # the journal is only trusted for staged files that survived; a recreated file would be all zeros
+            top_names = [os.path.basename(os.path.normpath(f)) for f in self.top_level]
+            existing = set(self._retry(self.backend.existing, [posixpath.join(self.staging, n) for p, n in self.files] +
+                                       [posixpath.join(self.destination, n) for n in top_names]))
+            files = list()
+            for top_name in top_names:
+                item_files = [(p, n) for p, n in self.files if n.split('/')[0] == top_name]
+                if self._already_committed(top_name, item_files, existing):
+                    continue
+                self.remaining.append(top_name)
+                for local_path, name in item_files:
+                    self.journal.entry(name, local_path)
+                    if posixpath.join(self.staging, name) not in existing:
+                        self.journal.reset(name)
+                    files.append((local_path, name))
+            self.files = files
+
+            directories = set([self.staging])
+            for f, top_name in zip(self.top_level, top_names):
+                if top_name in self.remaining and os.path.isdir(f):
+                    directories.add(posixpath.join(self.staging, top_name))
+            for local_path, name in self.files:
+                directories.add(posixpath.dirname(posixpath.join(self.staging, name)))
+            self._retry(self.backend.makedirs, sorted(directories))
+            entries = [self.journal.entry(name, local_path) for local_path, name in self.files]
+            self.stats['bytes'] = sum(entry['size'] for entry in entries)
+            self.stats['bytes_resumed'] = sum(
+                min(self.chunk_size, entry['size'] - offset) for entry in entries for offset in entry['done'])
+            self._retry(self.backend.prepare, [(posixpath.join(self.staging, name), entry['size'])
+                                               for (local_path, name), entry in zip(self.files, entries)])
+
+            verified = set()
+            with ThreadPoolExecutor(max_workers=self.streams) as executor:
+                for attempt in range(self.retries + 1):
+                    send_started = time.time()
+                    list(executor.map(self._send_chunk, self._pending_chunks()))
+                    self.stats['send_seconds'] += time.time() - send_started
+
+                    # every staged file is checked in this run, right before the rename, whatever the journal says
+                    verify_started = time.time()
+                    unverified = [item for item in self.files if item not in verified]
+                    results = list(executor.map(self._verify, unverified))
+                    verified.update(item for item, ok in zip(unverified, results) if ok)
+                    mismatched = [item for item, ok in zip(unverified, results) if not ok]
+                    self.stats['verify_seconds'] += time.time() - verify_started
+                    if not mismatched:
+                        break
+                    self.stats['retries'] += 1
+                else:
+                    raise RuntimeError('MD5 hashes of %s did not match after %s attempts.' % (
+                        ', '.join(n for p, n in mismatched), self.retries + 1))
+
+            renames = [(posixpath.join(self.staging, name), posixpath.join(self.destination, name))
+                       for name in self.remaining]
+            self._retry(self.backend.commit, renames, self.staging)
+        finally:
+            self.backend.close()
+        self.journal.remove()
+
+        self.stats['seconds'] = time.time() - started
+        if self.stats['send_seconds']:
+            self.stats['mb_per_second'] = self.stats['bytes_sent'] / 1048576.0 / self.stats['send_seconds']
+        for field in ['send_seconds', 'verify_seconds', 'seconds', 'mb_per_second']:
+            self.stats[field] = round(self.stats[field], 3)
+        return self.stats
+
+
+def send_files(backend, files, destination, **kwargs):
+    """Sends files and directories to destination through backend. See Transfer for the options."""
+    return Transfer(backend, files, destination, **kwargs).run()
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Sends files to a local or remote directory.')
+    parser.add_argument('files', action='store', nargs='+')  # files and directories to send
+    parser.add_argument('--destination', action='store', required=True)  # destination directory
+    parser.add_argument('--host', action='store')  # remote host, omit to copy locally
+    parser.add_argument('--username', action='store')
+    parser.add_argument('--password_file', action='store')  # for sshpass, omit to use ssh keys
+    parser.add_argument('--streams', action='store', type=int, default=4)  # chunks sent at once
+    return parser
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_args()
+    if args.host:
+        transfer_backend = SSHBackend(args.username, args.host, args.password_file)
+    else:
+        transfer_backend = LocalBackend()
+    print(json.dumps(send_files(transfer_backend, args.files, args.destination, streams=args.streams), indent=1))
@@ -0,0 +1,158 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+import traceback
+from pathlib import Path
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+
+def _load_inotify():
+    """Returns libc if it provides inotify, else None."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class DirectoryWatcher(object):
+    """Waits for files to be created, written or moved into a set of directories.
+
+    Uses inotify where available so a waiting process is woken as soon as a file lands. Otherwise, or if a watch
+    cannot be added, falls back to comparing directory listings every poll_interval seconds. Only the directories
+    themselves are watched, not their subdirectories.
+
+    Args:
+        directories (list): directories to watch
+        poll_interval (float): seconds between listings when polling
+
+    Yields:
+        inotify (bool): whether inotify is in use
+    """
+
+    def __init__(self, directories, poll_interval=30):
+        self.directories = [str(d) for d in directories]
+        self.poll_interval = poll_interval
+        self.fd = None
+        self.watches = dict()
+        self.snapshot = None
+        libc = _load_inotify()
+        if libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                for directory in self.directories:
+                    wd = libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK)
+                    if wd < 0:
+                        os.close(fd)
+                        self.watches = dict()
+                        break
+                    self.watches[wd] = directory
+                else:
+                    self.fd = fd
+        self.inotify = self.fd is not None
+        if not self.inotify:
+            self.snapshot = self._list()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _list(self):
+        listing = dict()
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        listing[entry.path] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                pass
+        return listing
+
+    def _read_events(self):
+        paths = list()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                path = os.path.join(self.watches.get(wd, ''), os.fsdecode(name))
+                if wd in self.watches and name and path not in paths:
+                    paths.append(path)
+        return paths
+
+    def wait(self, timeout):
+        """Blocks until files change in a watched directory or timeout seconds pass.
+
+        Returns:
+            paths (list): paths that were created, written or moved in, empty if the timeout passed
+        """
+        deadline = time.time() + timeout
+        if self.inotify:
+            readable, _, _ = select.select([self.fd], [], [], max(0, timeout))
+            return self._read_events() if readable else []
+
+        while True:
+            time.sleep(max(0, min(self.poll_interval, deadline - time.time())))
+            listing = self._list()
+            changed = [p for p, info in listing.items() if self.snapshot.get(p) != info]
+            self.snapshot = listing
+            if changed or time.time() >= deadline:
+                return changed
+
+
+def run_daemon(tick, directories, heartbeat, interval, poll_interval=30):
+    """Calls tick whenever files land in the watched directories, and at least every interval seconds.
+
+    tick may return the number of seconds until it next has work to do, to be woken sooner than interval. The
+    heartbeat file is touched before each tick, as the cron scripts do. Exceptions from tick are printed and the loop
+    carries on, so one bad run does not stop the daemon.
+
+    Args:
+        tick (callable): one pass of the automation
+        directories (list): directories whose changes should trigger a tick
+        heartbeat (str): file to touch on every pass
+        interval (float): maximum seconds between ticks
+        poll_interval (float): seconds between directory listings if inotify is unavailable
+    """
+    with DirectoryWatcher(directories, poll_interval=poll_interval) as watcher:
+        while True:
+            Path(heartbeat).touch()
+            next_due = None
+            try:
+                next_due = tick()
+            except Exception:
+                traceback.print_exc()
+                sys.stderr.flush()
+            watcher.wait(interval if next_due is None else min(interval, next_due + 1))